@@ -0,0 +1,298 @@
+# Benchmark for the HRV signal processing chain in main_V3.py.
+# Runs every stage on the same 30 s capture and reports the time and the bytes allocated per
+# stage. Results are appended to a history file and compared with the previous run on the
+# same platform and input, so a slower algorithm shows up right away.
+#
+# On the Pico (copy benchmark.py and optionally a capture file next to main_V3.py):
+#   >>> import benchmark
+#   >>> benchmark.main("capture_250Hz_01.txt", label="my change")
+# On a PC, through the simulation harness:
+#   python tools/benchmark.py --capture capture_250Hz_01.txt --label "my change"
+import array
+import gc
+import json
+import sys
+import time
+
+MICROPYTHON = sys.implementation.name == "micropython"
+SAMPLE_RATE = 250
+DURATION = 30
+HISTORY_FILE = "benchmark_history.jsonl"
+REGRESSION_LIMIT = 10 # % slower than the last run before it is flagged
+REGRESSION_MIN_US = 50 # and at least this much slower, tiny stages are mostly noise
+
+if MICROPYTHON:
+    def timer_start():
+        return time.ticks_us()
+
+    def timer_us(start):
+        return time.ticks_diff(time.ticks_us(), start)
+
+    # gc is off while the stage runs, so mem_alloc grows by exactly what it allocated
+    def alloc_start():
+        gc.collect()
+        gc.disable()
+        return gc.mem_alloc()
+
+    def alloc_bytes(start):
+        used = gc.mem_alloc() - start
+        gc.enable()
+        return used
+else:
+    import tracemalloc
+
+    def timer_start():
+        return time.perf_counter_ns()
+
+    def timer_us(start):
+        return (time.perf_counter_ns() - start) // 1000
+
+    # CPython frees as it goes, so this is the peak of new memory during the stage
+    def alloc_start():
+        gc.collect()
+        tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0]
+
+    def alloc_bytes(start):
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak - start
+
+
+# Reads `count` samples from a capture file (one value per line), looping if it is shorter
+def load_capture(filename, count):
+    data = array.array('H', [0] * count)
+    with open(filename) as f:
+        values = [int(line) for line in f if line.strip()]
+    for i in range(count):
+        data[i] = values[i % len(values)]
+    return data
+
+
+# Deterministic pulse-like signal when there is no capture file: ~72 bpm with some
+# beat-to-beat variation and noise, integer math only
+def synthetic_capture(count):
+    data = array.array('H', [0] * count)
+    seed = 1
+    beat = 0
+    ibi = 208
+    for i in range(count):
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        phase = i - beat
+        if phase >= ibi:
+            beat = i
+            phase = 0
+            ibi = 190 + (seed >> 8) % 40
+        if phase < 25:
+            pulse = phase * 360
+        elif phase < 85:
+            pulse = (85 - phase) * 150
+        else:
+            pulse = 0
+        data[i] = 30000 + pulse + (seed >> 16) % 200
+    return data
+
+
+# The batch versions of the BeatDetector stages, which main_V3 replaced with the streaming
+# detector: the low-pass filter over a whole capture, then the peak search over the filtered
+# signal. They use the app's Q16 filter step and ThresholdTracker, so the results match.
+def low_pass_filter(app, data, alpha=0.2):
+    a = app.to_q16(alpha)
+    low_pass_q16 = app.low_pass_q16
+    last_value = data[0]
+    for i in range(1, len(data)):
+        last_value = low_pass_q16(last_value, data[i], a)
+        data[i] = last_value
+    return data
+
+
+# Same threshold as BeatDetector: sample i is compared against the tracker's threshold after
+# sample i + 1 came in
+def peak_to_peak_intervals(tracker, data):
+    tracker.reset()
+    tracker.update(data[0])
+    tracker.update(data[1])
+    peaks_ms_list = []
+    lastpeak = 0
+    for i in range(1, len(data) - 1):
+        threshold = tracker.update(data[i + 1])
+        if data[i] >= data[i - 1] and data[i] > data[i + 1] and data[i] > threshold:
+            if lastpeak != 0:
+                indexdiff = i - lastpeak
+                if 100 < indexdiff < 400:
+                    peaks_ms_list.append(indexdiff * 4)
+            lastpeak = i
+    return peaks_ms_list
+
+
+# The float, multi-pass versions that main_V3 replaced (fixed point, then HrvStats), kept
+# here to compare their cost and results against the current ones
+def low_pass_filter_float(data, a=0.2):
+    last_value = data[0]
+    for i in range(1, len(data)):
+        filtered_value = a * data[i] + (1 - a) * last_value
+        data[i] = int(round(filtered_value))
+        last_value = data[i]
+    return data
+
+
+def moving_average_list(data, window_size=3):
+    return [int(sum(data[i:i + window_size]) / window_size) for i in range(len(data) - window_size + 1)]
+
+
+def rmssd_calc_float(data):
+    total = 0
+    for i in range(len(data) - 1):
+        total += (data[i + 1] - data[i]) ** 2
+    return (total / (len(data) - 1)) ** 0.5
+
+
+def sdnn_calc_float(data, mean_ppi):
+    total = 0
+    for i in data:
+        total += (i - mean_ppi) ** 2
+    return (total / (len(data) - 1)) ** 0.5
+
+
+def metrics_float(intervals):
+    mean_ppi = sum(intervals) / len(intervals)
+    mean_hr = 60 * 1000 / mean_ppi
+    return mean_ppi, mean_hr, rmssd_calc_float(intervals), sdnn_calc_float(intervals, mean_ppi)
+
+
+# Smoothing, mean PPI, mean HR, RMSSD and SDNN the old way: a new list and four passes
+def metrics_multi_pass_float(ppi):
+    return metrics_float(moving_average_list(ppi))
+
+
+# Artifact correction and the metrics through HrvAnalysis.add_interval and HrvStats, one pass
+# as the intervals arrive
+def metrics_streaming(hrv, ppi):
+    hrv.reset_intervals()
+    for interval in ppi:
+        hrv.add_interval(interval)
+    hrv.artifacts.flush()
+    stats = hrv.stats
+    return stats.mean_ppi(), stats.mean_hr(), stats.rmssd(), stats.sdnn()
+
+
+# The stages. Each one is (name, setup, run): setup builds the input outside the timing
+# and run(input) is the part that gets timed.
+def stages(app, capture):
+    hrv = app.hrv
+    tracker = app.ThresholdTracker()
+    filtered = low_pass_filter(app, array.array('H', capture))
+    ppi = peak_to_peak_intervals(tracker, filtered)
+
+    def run_detector(detector):
+        detector.reset()
+        process = detector.process
+        for sample in capture:
+            process(sample)
+
+    return [
+        ("low_pass_filter", lambda: array.array('H', capture), lambda data: low_pass_filter(app, data)),
+        ("low_pass_filter_float", lambda: array.array('H', capture), low_pass_filter_float),
+        ("peak_to_peak_intervals", lambda: filtered, lambda data: peak_to_peak_intervals(tracker, data)),
+        ("beat_detector_stream", lambda: hrv.detector, run_detector),
+        ("metrics_streaming", lambda: ppi, lambda data: metrics_streaming(hrv, data)),
+        ("metrics_multi_pass_float", lambda: ppi, metrics_multi_pass_float),
+        ("spectral_hrv", lambda: ppi, lambda data: hrv.spectrum.analyse(data, len(data))),
+    ]
+
+
+# Runs the whole chain both ways and prints how far the current results are from the float ones
+def compare_float(app, capture):
+    hrv = app.hrv
+    tracker = app.ThresholdTracker()
+    fixed_signal = low_pass_filter(app, array.array('H', capture))
+    float_signal = low_pass_filter_float(array.array('H', capture))
+    signal_diff = 0
+    for i in range(len(fixed_signal)):
+        signal_diff = max(signal_diff, abs(fixed_signal[i] - float_signal[i]))
+    print("filtered signal: max difference", signal_diff, "LSB")
+
+    fixed_ppi = peak_to_peak_intervals(tracker, fixed_signal)
+    float_ppi = peak_to_peak_intervals(tracker, float_signal)
+    if fixed_ppi != float_ppi:
+        print("intervals differ:", len(fixed_ppi), "fixed vs", len(float_ppi), "float")
+    if len(float_ppi) < 5:
+        return
+    current = metrics_streaming(hrv, fixed_ppi)
+    print("artifacts:", hrv.artifacts.missed, "missed,", hrv.artifacts.extra, "extra,",
+          hrv.artifacts.replaced, "replaced")
+    # The float metrics of the same corrected intervals
+    reference = metrics_float(list(hrv.buffers.scratch[:hrv.corrected_count]))
+    for name, value, ref in zip(("mean PPI", "mean HR", "RMSSD", "SDNN"), current, reference):
+        print("{:<9} {} (float {:.2f})".format(name, value, ref))
+
+
+def measure(setup, run, repeat):
+    best = None
+    for _ in range(repeat):
+        data = setup()
+        start = timer_start()
+        run(data)
+        us = timer_us(start)
+        if best is None or us < best:
+            best = us
+    data = setup()
+    start = alloc_start()
+    run(data)
+    return best, alloc_bytes(start)
+
+
+# Last run on the same platform with the same input, the only one worth comparing against
+def last_result(history_file, platform, capture):
+    last = None
+    try:
+        with open(history_file) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("platform") == platform and entry.get("capture") == capture:
+                    last = entry
+    except OSError:
+        pass
+    return last
+
+
+def run(app, capture=None, repeat=3, label="", history_file=HISTORY_FILE):
+    count = SAMPLE_RATE * DURATION
+    data = load_capture(capture, count) if capture else synthetic_capture(count)
+    platform = sys.platform + "/" + sys.implementation.name
+    source = capture or "synthetic"
+    previous = last_result(history_file, platform, source) if history_file else None
+
+    results = {}
+    print("stage                      time (us)   alloc (B)   vs last")
+    for name, setup, stage in stages(app, data):
+        us, alloc = measure(setup, stage, repeat)
+        results[name] = [us, alloc]
+        change = ""
+        if previous and name in previous["stages"] and previous["stages"][name][0]:
+            last_us = previous["stages"][name][0]
+            pct = (us - last_us) * 100 // last_us
+            change = ("+" if pct >= 0 else "") + str(pct) + "%"
+            if pct > REGRESSION_LIMIT and us - last_us >= REGRESSION_MIN_US:
+                change += "  REGRESSION"
+        print("{:<26} {:>9}   {:>9}   {}".format(name, us, alloc, change))
+    print()
+    compare_float(app, data)
+
+    entry = {
+        "time": time.time(),
+        "label": label,
+        "platform": platform,
+        "capture": source,
+        "stages": results,
+    }
+    if history_file:
+        with open(history_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+# Entry point on the device: imports the app itself
+def main(capture=None, repeat=3, label=""):
+    import main_V3
+    return run(main_V3, capture, repeat, label)
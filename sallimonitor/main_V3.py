@@ -1,21 +1,71 @@
+import time
+boot_start = time.ticks_us()
 from machine import Pin, I2C, ADC
 from piotimer import Piotimer
 from ssd1306 import SSD1306_I2C
 from fifo import Fifo
-import time
 import ujson
 import gc
 import micropython
 import array
-from umqtt.simple import MQTTClient
-import network
+import struct
+import math
+import os
+import _thread
+import uasyncio as asyncio
+# network and umqtt.simple are imported when the network is first needed, see Wlan and MqttConnection
 
 
 micropython.alloc_emergency_exception_buf(200)
 
 SAMPLE_RATE = 250
+WLAN_SSID = "KME751_Group_5"
+WLAN_PASSWORD = "Nakkivene1"
+BROKER_IP = "192.168.50.253"
+BROKER_PORT = 21884
+DUAL_CORE = True # HRV and Kubios captures sample on core 1, see CaptureWorker
 state = 0
 
+# Boot profile: boot_mark() after each startup step, boot_report() prints how long each took
+boot_marks = [("imports", time.ticks_us())]
+
+def boot_mark(name):
+    boot_marks.append((name, time.ticks_us()))
+
+def boot_report():
+    print("Boot profile (ms):")
+    last = boot_start
+    for name, t in boot_marks:
+        print(f"  {name:<14}{time.ticks_diff(t, last) / 1000:8.1f}")
+        last = t
+    print(f"  {'total':<14}{time.ticks_diff(last, boot_start) / 1000:8.1f}")
+
+# The RP2040 has no FPU, so the filters and HRV metrics use integers only.
+# Filter coefficients are Q16 fixed point: alpha 0.2 -> round(0.2 * 65536) = 13107.
+Q16 = 65536
+
+def to_q16(value):
+    return int(value * Q16 + 0.5)
+
+# One step of the exponential low-pass filter, round(alpha * sample + (1 - alpha) * prev)
+# in Q16. Written as prev + alpha * (sample - prev) so the product stays a small int.
+def low_pass_q16(prev, sample, alpha_q16):
+    return prev + ((alpha_q16 * (sample - prev) + 32768) >> 16)
+
+# Integer square root (Newton), rounded to the nearest integer of sqrt(num / den)
+def isqrt_round(num, den=1):
+    value = num // den
+    if value <= 0:
+        return 1 if 4 * num >= den else 0 # sqrt >= 0.5
+    root = value
+    guess = (root + 1) >> 1
+    while guess < root:
+        root = guess
+        guess = (root + value // root) >> 1
+    if 4 * num >= den * (2 * root + 1) * (2 * root + 1): # sqrt >= root + 0.5
+        root += 1
+    return root
+
 class RotaryEncoder:
     def __init__(self, btn_pin=12, a_pin=10, b_pin=11):
         self.sw = Pin(btn_pin, mode=Pin.IN, pull=Pin.PULL_UP)
@@ -24,6 +74,7 @@ class RotaryEncoder:
         self.debounce_time = 100
         
         self.fifo = Fifo(30, typecode='i')
+        self.flag = asyncio.ThreadSafeFlag() # wakes the encoder task
         
         # Interrupts for rotary encoder
         self.a.irq(handler=self.on_rotary_rotated, trigger=Pin.IRQ_RISING, hard=True)
@@ -40,29 +91,741 @@ class RotaryEncoder:
                 self.fifo.put(-1)
             else:         # Counter-clockwise rotation
                 self.fifo.put(1)
+            self.flag.set()
 
     def on_rotary_pressed(self, pin):
         current_time = time.ticks_ms()
         if time.ticks_diff(current_time, self.last_press_time) > self.debounce_time:
             self.last_press_time = current_time
             self.fifo.put(2)  # Button press
+            self.flag.set()
 
     def get_event(self):
         if self.fifo.has_data():
             return self.fifo.get()
         return None
 
-class MainMenu:
-    def __init__(self, rotary_encoder):
+# SSD1306 commands used for partial updates
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+class Display(SSD1306_I2C):
+    # SSD1306 that only sends what changed since the last show(). What the panel shows is kept
+    # in a shadow copy; there is only one Display (see Hardware), so it always matches the panel.
+    # For each 8 pixel high page only the changed column range is sent, and an identical frame
+    # sends nothing at all.
+    shown = None # bytearray copy of the panel after the first frame
+
+    def show(self):
+        if self.shown is None: # first frame (the driver's init), send it all
+            super().show()
+            self.shown = bytearray(self.buffer)
+            return
+        self.flush(self.buffer, self.shown)
+
+    @micropython.native
+    def flush(self, buf, shown):
+        width = self.width
+        for page in range(self.pages):
+            start = page * width
+            end = start + width
+            x0 = start
+            while x0 < end and buf[x0] == shown[x0]:
+                x0 += 1
+            if x0 == end: # page unchanged
+                continue
+            x1 = end - 1
+            while buf[x1] == shown[x1]:
+                x1 -= 1
+            self.write_cmd(SET_COL_ADDR)
+            self.write_cmd(x0 - start)
+            self.write_cmd(x1 - start)
+            self.write_cmd(SET_PAGE_ADDR)
+            self.write_cmd(page)
+            self.write_cmd(page)
+            changed = memoryview(buf)[x0:x1 + 1]
+            self.write_data(changed)
+            shown[x0:x1 + 1] = changed
+
+# Every peripheral is created once here and shared by all the screens: one I2C bus, one
+# display (one 1 KB framebuffer, one init sequence), one ADC and the LED.
+class Hardware:
+    def __init__(self):
+        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
+        self.OLED = Display(128, 64, self.i2c)
+        self.adc = ADC(Pin(26))
+        self.led = Pin(22, Pin.OUT)
+
+class BufferPool:
+    # All measurement buffers are allocated once at boot and handed out as memoryviews.
+    # Every screen reuses the same memory, so a measurement does not build new arrays.
+    def __init__(self, sample_rate, hr_duration=4, max_beats=128, fft_size=256):
+        self.samples = memoryview(array.array('H', [0] * (sample_rate * hr_duration))) # HR ring buffer
+        self.thresholds = memoryview(array.array('H', [0] * (sample_rate * hr_duration))) # threshold per HR sample
+        self.ppi = memoryview(array.array('H', [0] * max_beats))     # peak-to-peak intervals (ms)
+        self.scratch = memoryview(array.array('H', [0] * max_beats)) # corrected intervals
+        self.block = memoryview(array.array('H', [0] * 32)) # samples taken from a SpscRing at once
+        self.fft_re = array.array('i', [0] * fft_size) # spectral HRV, real and imaginary parts
+        self.fft_im = array.array('i', [0] * fft_size)
+
+# Lock-free single-producer single-consumer ring. Only the producer writes `head`, `dropped`
+# and `high_water`, only the consumer writes `tail`, and a slot is filled before head moves
+# past it, so an interrupt handler or core 1 can hand values to the main loop without a lock.
+# drain_into() takes everything waiting in one call and allocates nothing.
+class SpscRing:
+    def __init__(self, size, typecode='H'):
+        self.data = array.array(typecode, [0] * size)
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0    # puts that found the ring full
+        self.high_water = 0 # most values ever waiting at once
+
+    def __len__(self):
+        n = self.head - self.tail
+        return n + self.size if n < 0 else n
+
+    def put(self, value): # producer
+        head = self.head
+        nxt = head + 1
+        if nxt == self.size:
+            nxt = 0
+        if nxt == self.tail:
+            self.dropped += 1
+            return False
+        self.data[head] = value
+        self.head = nxt
+        fill = nxt - self.tail
+        if fill < 0:
+            fill += self.size
+        if fill > self.high_water:
+            self.high_water = fill
+        return True
+
+    # Consumer: copies up to len(buf) values into the memoryview buf, returns how many.
+    # An index loop, a slice of the ring would be a new memoryview object on every call.
+    @micropython.native
+    def drain_into(self, buf):
+        data = self.data
+        size = self.size
+        tail = self.tail
+        n = self.head - tail
+        if n < 0:
+            n += size
+        if n > len(buf):
+            n = len(buf)
+        for i in range(n):
+            buf[i] = data[tail]
+            tail += 1
+            if tail == size:
+                tail = 0
+        self.tail = tail
+        return n
+
+    def get(self): # consumer, check empty() first
+        tail = self.tail
+        value = self.data[tail]
+        self.tail = tail + 1 if tail + 1 < self.size else 0
+        return value
+
+    def empty(self):
+        return self.head == self.tail
+
+    def clear(self): # consumer, drops everything that is in the ring
+        self.tail = self.head
+
+class ThresholdTracker:
+    # Adaptive peak threshold, updated one sample at a time in O(1) with integer math.
+    # Keeps a running mean (exponential, ~2 s) and a max/min envelope that decays towards
+    # the mean (~4 s), so the threshold follows baseline wander during a long measurement.
+    # The envelope starts at the first sample, so until it has seen a full beat the threshold
+    # is UNSETTLED, above any 16-bit sample: no peaks yet, not even the dicrotic notch.
+    # The beat is done when the signal rises above the level after `settle` samples below it
+    # (the trough is in the envelope then), at the latest after 2**mean_shift samples.
+    UNSETTLED = 65535
+
+    def __init__(self, mean_shift=9, decay_shift=10, level=60, settle=50):
+        self.mean_shift = mean_shift   # mean time constant 2**9 samples
+        self.decay_shift = decay_shift # envelope time constant 2**10 samples
+        self.level = level             # threshold in % of the way from envelope min to max
+        self.settle = settle           # 200 ms below the level, longer than the noise stays
+        self.reset()
+
+    def reset(self):
+        self.acc = 0       # mean << mean_shift
+        self.mean = 0
+        self.hi = 0        # envelope max
+        self.lo = 0        # envelope min
+        self.threshold = self.UNSETTLED
+        self.started = False
+        self.warmup = 1 << self.mean_shift # samples left before the threshold is used anyway
+        self.below = 0     # samples in a row below the level during warm-up
+
+    def update(self, sample):
+        if not self.started:
+            self.acc = sample << self.mean_shift
+            self.hi = sample
+            self.lo = sample
+            self.started = True
+        self.acc += sample - (self.acc >> self.mean_shift)
+        self.mean = self.acc >> self.mean_shift
+
+        if sample > self.hi:
+            self.hi = sample
+        else:
+            self.hi -= (self.hi - self.mean) >> self.decay_shift
+        if sample < self.lo:
+            self.lo = sample
+        else:
+            self.lo += (self.mean - self.lo) >> self.decay_shift
+
+        threshold = self.lo + (self.hi - self.lo) * self.level // 100
+        if self.warmup:
+            if sample < threshold:
+                self.below += 1
+            elif self.below >= self.settle: # upstroke after the trough
+                self.warmup = 0
+            else:
+                self.below = 0
+            if self.warmup:
+                self.warmup -= 1
+                return self.threshold
+        self.threshold = threshold
+        return threshold
+
+class BeatDetector:
+    # Streaming version of the batch low-pass filter and peak search (now in benchmark.py).
+    # Feed one sample at a time with process(), it returns the peak-to-peak interval in ms
+    # when a new valid beat is found and 0 otherwise. State is a few ints, no sample buffer.
+    def __init__(self, sample_rate=250, min_peak_distance=100, max_peak_distance=400, alpha=0.2):
+        self.ms_per_sample = 1000 // sample_rate
+        self.min_peak_distance = min_peak_distance
+        self.max_peak_distance = max_peak_distance
+        self.alpha = to_q16(alpha)
+        self.tracker = ThresholdTracker()
+        self.reset()
+
+    def reset(self):
+        self.index = 0          # index of the newest sample
+        self.last_peak = 0      # index of the last peak, 0 = no peak yet
+        self.tracker.reset()
+        self.prev2 = 0          # filtered sample at index - 2
+        self.prev1 = 0          # filtered sample at index - 1
+
+    def process(self, sample):
+        if self.index == 0:
+            filtered = sample # first sample passes through like in the batch filter
+        else:
+            filtered = low_pass_q16(self.prev1, sample, self.alpha)
+        threshold = self.tracker.update(filtered)
+
+        ppi = 0
+        # prev1 is a peak if it is higher than the next sample and not lower than the one
+        # before: the filter output often repeats a value at the top of a slow peak
+        peak = self.index - 1
+        if peak > 0 and self.prev1 >= self.prev2 and self.prev1 > filtered and self.prev1 > threshold:
+            if self.last_peak != 0:
+                indexdiff = peak - self.last_peak
+                if self.min_peak_distance < indexdiff < self.max_peak_distance:
+                    ppi = indexdiff * self.ms_per_sample
+            self.last_peak = peak
+
+        self.prev2 = self.prev1
+        self.prev1 = filtered
+        self.index += 1
+        return ppi
+
+# Runs a capture on core 1: samples the ADC at the sample rate, runs the beat detector and
+# puts the intervals in a SpscRing for core 0, which then only does the UI and the network.
+# Core 0 writes `requested` and `stopped`, core 1 writes `index` and `finished`, so the two
+# cores never need a lock. The thread starts on the first capture and then waits for the next.
+class CaptureWorker:
+    def __init__(self, adc, detector, sample_rate, queue_size=32):
+        self.adc = adc
+        self.detector = detector
+        self.period_us = 1000000 // sample_rate
+        self.intervals = SpscRing(queue_size)
+        self.length = 0    # samples per capture
+        self.requested = 0 # number of the last capture core 0 asked for
+        self.stopped = 0   # number of the last capture core 0 cancelled
+        self.finished = 0  # number of the last capture core 1 ended
+        self.index = 0     # samples taken of the running capture
+        self.late = 0      # samples taken after their time, core 1 was busy
+        self.thread = False
+
+    def idle(self):
+        return self.finished == self.requested
+
+    # Core 0: starts a capture of `length` samples
+    def start(self, length):
+        self.stop()
+        self.intervals.clear()
+        self.length = length
+        self.index = 0
+        self.requested += 1
+        if not self.thread:
+            self.thread = True
+            _thread.start_new_thread(self.run, ())
+
+    # Core 0: cancels the running capture, returns once core 1 has let go of the detector
+    def stop(self):
+        self.stopped = self.requested
+        while not self.idle():
+            time.sleep_ms(1)
+
+    # Core 1
+    def run(self):
+        while True:
+            capture = self.requested
+            if capture == self.finished:
+                time.sleep_ms(5)
+                continue
+            self.capture(capture)
+            self.finished = capture
+
+    def capture(self, capture):
+        detector = self.detector
+        read = self.adc.read_u16
+        put = self.intervals.put
+        detector.reset()
+        index = 0
+        next_us = time.ticks_us()
+        while index < self.length and self.stopped != capture:
+            next_us = time.ticks_add(next_us, self.period_us)
+            wait = time.ticks_diff(next_us, time.ticks_us())
+            if wait > 0:
+                time.sleep_us(wait)
+            else:
+                self.late += 1
+            ppi = detector.process(read())
+            if ppi:
+                put(ppi)
+            index += 1
+            self.index = index
+
+class HrvStats:
+    # Single-pass HRV statistics: add() takes one interval (ms) at a time and mean PPI, mean HR,
+    # SDNN, RMSSD, min/max and the beat count can be read at any point, no second pass.
+    # Like Welford's method the variance comes from deviations, here from the first interval
+    # (shifted data), which keeps every sum an exact small int without a division per beat.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.first = 0       # shift for the deviations
+        self.sum_dev = 0     # sum of (ppi - first)
+        self.sum_dev2 = 0    # sum of (ppi - first)**2
+        self.sum_diff2 = 0   # sum of successive differences squared
+        self.last = 0
+        self.min = 0
+        self.max = 0
+
+    def add(self, ppi):
+        if self.count == 0:
+            self.first = ppi
+            self.min = ppi
+            self.max = ppi
+        else:
+            diff = ppi - self.last
+            self.sum_diff2 += diff * diff
+            if ppi < self.min:
+                self.min = ppi
+            elif ppi > self.max:
+                self.max = ppi
+        dev = ppi - self.first
+        self.sum_dev += dev
+        self.sum_dev2 += dev * dev
+        self.last = ppi
+        self.count += 1
+
+    def mean_ppi(self): # ms, rounded
+        n = self.count
+        return self.first + (2 * self.sum_dev + n) // (2 * n) if n else 0
+
+    def mean_hr(self): # 60000 / exact mean PPI, rounded
+        total = self.first * self.count + self.sum_dev
+        return (60000 * self.count + total // 2) // total if total else 0
+
+    def rmssd(self):
+        return isqrt_round(self.sum_diff2, self.count - 1) if self.count > 1 else 0
+
+    def sdnn(self): # sqrt((n * sum(dev**2) - sum(dev)**2) / (n * (n - 1)))
+        n = self.count
+        if n < 2:
+            return 0
+        return isqrt_round(n * self.sum_dev2 - self.sum_dev * self.sum_dev, n * (n - 1))
+
+# Median of the last `size` values (16-bit). The lower half of the window is a max-heap and
+# the upper half a min-heap, both holding slots of a ring of the values, and `where` keeps each
+# slot's heap position. Replacing the oldest value is a sift in its heap and at most one swap
+# of the two tops, O(log size), in arrays allocated once.
+class RunningMedian:
+    def __init__(self, size=9):
+        self.size = size
+        self.values = array.array('H', [0] * size)
+        self.lo = array.array('B', [0] * ((size + 1) // 2 + 1)) # max-heap
+        self.hi = array.array('B', [0] * (size // 2 + 1))       # min-heap
+        self.where = array.array('b', [0] * size) # slot -> pos + 1 in lo, -(pos + 1) in hi
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.oldest = 0
+        self.nlo = 0
+        self.nhi = 0
+
+    # sign is 1 for lo and -1 for hi, so one set of sift functions does both heaps
+    def _place(self, heap, sign, pos, slot):
+        heap[pos] = slot
+        self.where[slot] = (pos + 1) * sign
+
+    def _sift_up(self, heap, sign, pos):
+        values = self.values
+        slot = heap[pos]
+        key = values[slot] * sign
+        while pos:
+            parent = (pos - 1) >> 1
+            if values[heap[parent]] * sign >= key:
+                break
+            self._place(heap, sign, pos, heap[parent])
+            pos = parent
+        self._place(heap, sign, pos, slot)
+
+    def _sift_down(self, heap, sign, pos, n):
+        values = self.values
+        slot = heap[pos]
+        key = values[slot] * sign
+        while True:
+            child = 2 * pos + 1
+            if child >= n:
+                break
+            if child + 1 < n and values[heap[child + 1]] * sign > values[heap[child]] * sign:
+                child += 1
+            if values[heap[child]] * sign <= key:
+                break
+            self._place(heap, sign, pos, heap[child])
+            pos = child
+        self._place(heap, sign, pos, slot)
+
+    def _push_lo(self, slot):
+        self.lo[self.nlo] = slot
+        self.nlo += 1
+        self._sift_up(self.lo, 1, self.nlo - 1)
+
+    def _push_hi(self, slot):
+        self.hi[self.nhi] = slot
+        self.nhi += 1
+        self._sift_up(self.hi, -1, self.nhi - 1)
+
+    def _pop_lo(self):
+        slot = self.lo[0]
+        self.nlo -= 1
+        self._place(self.lo, 1, 0, self.lo[self.nlo])
+        self._sift_down(self.lo, 1, 0, self.nlo)
+        return slot
+
+    def _pop_hi(self):
+        slot = self.hi[0]
+        self.nhi -= 1
+        self._place(self.hi, -1, 0, self.hi[self.nhi])
+        self._sift_down(self.hi, -1, 0, self.nhi)
+        return slot
+
+    def add(self, value):
+        values = self.values
+        if self.count < self.size:
+            slot = self.count
+            self.count += 1
+            values[slot] = value
+            if self.nlo and value > values[self.lo[0]]:
+                self._push_hi(slot)
+            else:
+                self._push_lo(slot)
+            # lo holds the middle value: nlo is nhi or nhi + 1
+            if self.nlo > self.nhi + 1:
+                self._push_hi(self._pop_lo())
+            elif self.nhi > self.nlo:
+                self._push_lo(self._pop_hi())
+            return
+        slot = self.oldest
+        self.oldest = slot + 1 if slot + 1 < self.size else 0
+        values[slot] = value
+        pos = self.where[slot]
+        if pos > 0:
+            self._sift_up(self.lo, 1, pos - 1)
+            self._sift_down(self.lo, 1, self.where[slot] - 1, self.nlo)
+        else:
+            self._sift_up(self.hi, -1, -pos - 1)
+            self._sift_down(self.hi, -1, -self.where[slot] - 1, self.nhi)
+        # The new value may belong to the other half, then it is the top of its heap
+        lo_top = self.lo[0]
+        hi_top = self.hi[0]
+        if self.nhi and values[lo_top] > values[hi_top]:
+            self._place(self.lo, 1, 0, hi_top)
+            self._place(self.hi, -1, 0, lo_top)
+            self._sift_down(self.lo, 1, 0, self.nlo)
+            self._sift_down(self.hi, -1, 0, self.nhi)
+
+    def median(self):
+        if self.nlo == 0:
+            return 0
+        if self.nlo > self.nhi:
+            return self.values[self.lo[0]]
+        return (self.values[self.lo[0]] + self.values[self.hi[0]] + 1) >> 1
+
+# Artifact correction for the intervals as they arrive, against the running median of the
+# last `window` intervals. One more than `tolerance` % off the median is corrected:
+#  - about k times the median (missed beats): split into k intervals
+#  - short, and the next one completes it to about the median (extra beat): merged
+#  - anything else (ectopic beat, noise): replaced by the median
+# Corrected intervals go to emit(). A short one waits for the next interval, so the output can
+# lag one beat. The first `warmup` intervals are held until there are enough for a median and
+# then checked against it like the rest. flush() releases what is held at the end of a capture.
+class ArtifactFilter:
+    def __init__(self, emit, window=9, tolerance=20, warmup=5, max_missed=3):
+        self.emit = emit
+        self.window = RunningMedian(window)
+        self.tolerance = tolerance
+        self.warmup = warmup
+        self.held = array.array('H', [0] * warmup) # warm-up intervals, not emitted yet
+        self.max_missed = max_missed
+        self.reset()
+
+    def reset(self):
+        self.window.reset()
+        self.held_count = 0
+        self.warming = True
+        self.pending = 0 # short interval waiting for the next one
+        self.missed = 0
+        self.extra = 0
+        self.replaced = 0
+
+    def corrected(self):
+        return self.missed + self.extra + self.replaced
+
+    def accept(self, ppi):
+        self.window.add(ppi)
+        self.emit(ppi)
+
+    def add(self, ppi):
+        if self.warming:
+            self.held[self.held_count] = ppi
+            self.held_count += 1
+            self.window.add(ppi)
+            if self.held_count == self.warmup:
+                self.release()
+            return
+        self.check(ppi, self.window.median())
+
+    # Checks the held intervals against their own median, then the window refills with
+    # the corrected ones
+    def release(self):
+        self.warming = False
+        median = self.window.median()
+        self.window.reset()
+        for i in range(self.held_count):
+            self.check(self.held[i], median)
+
+    def check(self, ppi, median):
+        limit = median * self.tolerance // 100
+        if self.pending:
+            short = self.pending
+            self.pending = 0
+            if abs(short + ppi - median) <= limit:
+                self.extra += 1
+                self.accept(short + ppi)
+                return
+            self.replace(short, median)
+        if abs(ppi - median) <= limit:
+            self.accept(ppi)
+        elif ppi < median:
+            self.pending = ppi
+        else:
+            beats = (ppi + median // 2) // median
+            if beats <= self.max_missed and abs(ppi - beats * median) <= limit:
+                self.missed += beats - 1
+                part = ppi // beats
+                for i in range(beats - 1):
+                    self.accept(part)
+                self.accept(ppi - part * (beats - 1))
+            else:
+                self.replace(ppi, median)
+
+    # The raw value still goes to the window, so a real change of rate moves the median
+    def replace(self, ppi, median):
+        self.replaced += 1
+        self.window.add(ppi)
+        self.emit(median)
+
+    def flush(self):
+        if self.warming and self.held_count:
+            self.release()
+        if self.pending:
+            self.replace(self.pending, self.window.median() or self.pending)
+            self.pending = 0
+
+# Frequency-domain HRV (LF and HF power) from the PPI series, integer math only.
+# The intervals are resampled to `points` evenly spaced values over the series (linear
+# interpolation), the mean is removed, a Hann window applied and the rest zero padded for a
+# radix-2 FFT of `fft_size`. Each FFT stage halves the values, so they stay within 16 bits
+# and every product with a Q15 twiddle is a small int. The twiddle, window and bit reversal
+# tables are made once here; the FFT runs in the BufferPool arrays.
+class SpectralHrv:
+    LF_BAND = (40, 150)  # mHz
+    HF_BAND = (150, 400)
+    SCALE = 5            # intervals are shifted left by this before the window (1/32 ms steps)
+
+    def __init__(self, buffers, points=128):
+        self.re = buffers.fft_re
+        self.im = buffers.fft_im
+        self.size = n = len(self.re)
+        self.points = points
+        bits = 0
+        while (1 << bits) < n:
+            bits += 1
+        self.cos = array.array('h', [round(32767 * math.cos(2 * math.pi * k / n)) for k in range(n // 2)])
+        self.sin = array.array('h', [round(32767 * math.sin(2 * math.pi * k / n)) for k in range(n // 2)])
+        self.bitrev = array.array('H', [0] * n)
+        for i in range(n):
+            for bit in range(bits):
+                if i & (1 << bit):
+                    self.bitrev[i] |= 1 << (bits - 1 - bit)
+        self.window = array.array('h', [round(32767 * (0.5 - 0.5 * math.cos(2 * math.pi * i / (points - 1))))
+                                        for i in range(points)])
+        self.window_power = sum(w * w for w in self.window) >> 15 # sum of w**2, Q15
+
+    # Fills re with the windowed, detrended series. Returns its span in ms (first to last beat).
+    def resample(self, ppi, count):
+        re = self.re
+        im = self.im
+        points = self.points
+        span = 0
+        for i in range(1, count):
+            span += ppi[i]
+        # Interval i is placed at the time of the beat that ends it, relative to the first one
+        i = 0
+        t_i = 0
+        t_next = ppi[1]
+        total = 0
+        for j in range(points):
+            t = j * span // (points - 1)
+            while t > t_next and i < count - 2:
+                i += 1
+                t_i = t_next
+                t_next += ppi[i + 1]
+            value = ppi[i] + (ppi[i + 1] - ppi[i]) * (t - t_i) // (t_next - t_i)
+            re[j] = value
+            total += value
+        mean = (total + points // 2) // points
+        window = self.window
+        for j in range(points):
+            re[j] = (((re[j] - mean) << self.SCALE) * window[j]) >> 15
+            im[j] = 0
+        for j in range(points, self.size):
+            re[j] = 0
+            im[j] = 0
+        return span
+
+    # In-place radix-2 FFT of re/im, the result divided by fft_size
+    @micropython.native
+    def fft(self):
+        re = self.re
+        im = self.im
+        cos = self.cos
+        sin = self.sin
+        bitrev = self.bitrev
+        n = self.size
+        for i in range(n):
+            j = bitrev[i]
+            if j > i:
+                re[i], re[j] = re[j], re[i]
+                im[i], im[j] = im[j], im[i]
+        half = 1
+        while half < n:
+            step = n // (half * 2)
+            for start in range(0, n, half * 2):
+                k = 0
+                for a in range(start, start + half):
+                    b = a + half
+                    wr = cos[k]
+                    wi = sin[k] # e**(-2j*pi*k/n) = cos - j*sin
+                    tr = (re[b] * wr + im[b] * wi) >> 15
+                    ti = (im[b] * wr - re[b] * wi) >> 15
+                    re[b] = (re[a] - tr) >> 1
+                    im[b] = (im[a] - ti) >> 1
+                    re[a] = (re[a] + tr) >> 1
+                    im[a] = (im[a] + ti) >> 1
+                    k += step
+            half *= 2
+
+    # (LF, HF) power in ms**2, or None with too few intervals
+    def analyse(self, ppi, count):
+        if count < 4:
+            return None
+        span = self.resample(ppi, count)
+        if span <= 0:
+            return None
+        self.fft()
+        # Bin k is at k / (size * sample spacing) = k * (points - 1) / (size * span) Hz
+        scale = 1000000 * (self.points - 1)
+        bin_den = self.size * span
+        lf = 0
+        hf = 0
+        re = self.re
+        im = self.im
+        for k in range(1, self.size // 2):
+            f = k * scale // bin_den # mHz
+            if f >= self.HF_BAND[1]:
+                break
+            power = re[k] * re[k] + im[k] * im[k]
+            if f >= self.HF_BAND[0]:
+                hf += power
+            elif f >= self.LF_BAND[0]:
+                lf += power
+        # One-sided band power: 2 * size * sum(|X/size|**2) / sum(w**2), undoing SCALE and Q15
+        gain = 2 * self.size << (15 - 2 * self.SCALE)
+        den = self.window_power
+        return ((gain * lf + den // 2) // den, (gain * hf + den // 2) // den)
+
+    @staticmethod
+    def ratio(lf, hf): # LF/HF * 100, rounded
+        return (100 * lf + hf // 2) // hf if hf else 0
+
+# Base for the screens. The tasks at the bottom of the file call these on the screen of the
+# current state: on_event() for rotary events, process_samples() to drain the sample fifo and
+# update() to redraw. enter() and leave() run when the state changes.
+class Screen:
+    def core0_sampling(self): # True while a timer interrupt samples on core 0, see network_task
+        return False
+    
+    def enter(self):
+        pass
+    
+    def leave(self):
+        pass
+    
+    def on_event(self, event):
+        pass
+    
+    def process_samples(self):
+        pass
+    
+    def update(self):
+        pass
+
+class MainMenu(Screen):
+    def __init__(self, rotary_encoder, hw):
         
         self.rotary_encoder = rotary_encoder
         # I2C and OLED setup
-        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-        self.OLED = SSD1306_I2C(128, 64, self.i2c)
+        self.i2c = hw.i2c
+        self.OLED = hw.OLED
 
         # Menu logic
         self.menu_items = ["Heart rate", "HRV analysis", "Kubios", "History"]
         self.selected_index = 0  # Initially select the first menu item
+        self.dirty = True # redraw on the next update
 
 
     def draw(self):
@@ -76,92 +839,153 @@ class MainMenu:
                 self.OLED.text(f"{item}", 0, y_position, 1)  # Regular text
         self.OLED.show()  # Update the screen
 
+    def enter(self):
+        self.dirty = True
         
-    def execute(self):
+    def on_event(self, event):
         global state
         
-        if self.rotary_encoder.fifo.has_data():
-            event = self.rotary_encoder.fifo.get() # Get the first event in fifo
-            if event == 1:  # Clockwise rotation event
-                if self.selected_index < len(self.menu_items) - 1:
-                    self.selected_index = (self.selected_index + 1)
-                    print(self.selected_index)
-            elif event == -1:  # Counter-clockwise rotation event
-                if self.selected_index > 0:
-                    self.selected_index = (self.selected_index - 1)
-                    print(self.selected_index)
-            elif event == 2:  # Button press event
-                if self.selected_index == 0:
-                    state = 1
-                elif self.selected_index == 1:
-                    state = 2
-                elif self.selected_index == 2:
-                    state = 3
-                elif self.selected_index == 3:
-                    state = 4
-                    
-            
-            if self.selected_index > len(self.menu_items) - 1: # Making sure menu arrow doesn't go "out of bounds"
-                self.selected_index = 0
-            elif self.selected_index < 0:
-                self.selected_index = len(self.menu_items) - 1
-        self.draw()
+        if event == 1:  # Clockwise rotation event
+            if self.selected_index < len(self.menu_items) - 1:
+                self.selected_index = (self.selected_index + 1)
+                print(self.selected_index)
+        elif event == -1:  # Counter-clockwise rotation event
+            if self.selected_index > 0:
+                self.selected_index = (self.selected_index - 1)
+                print(self.selected_index)
+        elif event == 2:  # Button press event
+            if self.selected_index == 0:
+                state = 1
+            elif self.selected_index == 1:
+                state = 2
+            elif self.selected_index == 2:
+                state = 3
+            elif self.selected_index == 3:
+                state = 4
+                
+        
+        if self.selected_index > len(self.menu_items) - 1: # Making sure menu arrow doesn't go "out of bounds"
+            self.selected_index = 0
+        elif self.selected_index < 0:
+            self.selected_index = len(self.menu_items) - 1
+        self.dirty = True
+    
+    def update(self):
+        if self.dirty:
+            self.draw()
+            self.dirty = False
         
         
-class HrMeasurement:
-    def __init__(self, rotary_encoder, sample_rate):
+class HrMeasurement(Screen):
+    def __init__(self, rotary_encoder, hw, sample_rate, buffers, sliding_window=True, window_beats=5):
         
         self.rotary_encoder = rotary_encoder
-        self.adc = ADC(26)  
+        self.adc = hw.adc
         self.sample_rate = sample_rate
+        self.sliding_window = sliding_window # True = new BPM on every beat, False = one BPM per 4 s buffer
         self.data_segment_duration = 4  # seconds
         self.min_peak_distance = 100 # 400ms, ~190 bpm
         self.max_peak_distance = 400 # 1600ms, ~30 bpm
-        self.buffer_size = self.sample_rate * self.data_segment_duration
-        self.buffer = array.array('H', [0] * self.buffer_size) 
-        self.fifo = Fifo(30, typecode='i')
+        self.buffer = buffers.samples # preallocated data_segment_duration * sample_rate samples
+        self.thresholds = buffers.thresholds # the tracker's threshold when each sample came in
+        self.samples = SpscRing(64) # filled by the timer interrupt
+        self.block = buffers.block
         self.buffer_index = 0 
         self.bpm = None
         self.start_up = True
+        self.dirty = False # new BPM to draw
         self.prev_filtered_value = 0
-        self.led = Pin(22, Pin.OUT)
+        self.tracker = ThresholdTracker() # updated per sample, so calculate_data needs no extra pass
+        self.led = hw.led
+        self.tmr = None
+        
+        # Sliding window mode: BPM from the mean of the last window_beats intervals
+        self.detector = BeatDetector(sample_rate, self.min_peak_distance, self.max_peak_distance, alpha=0.1)
+        self.window = array.array('H', [0] * window_beats) # ring of the latest intervals (ms)
+        self.window_index = 0
+        self.window_count = 0
+        self.window_sum = 0 # running sum of the intervals in the window
 
         # I2C and OLED setup
-        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-        self.OLED = SSD1306_I2C(128, 64, self.i2c)
+        self.i2c = hw.i2c
+        self.OLED = hw.OLED
     
     def read_adc(self, timer):
         sample = self.adc.read_u16()
-        self.fifo.put(sample)
+        self.samples.put(sample)
         
-    def low_pass_filter(self, sample, alpha=0.1):
-        self.prev_filtered_value = alpha * sample + (1 - alpha) * self.prev_filtered_value
-        return int(self.prev_filtered_value)
+    def low_pass_filter(self, sample, alpha=to_q16(0.1)):
+        if not self.tracker.started: # first sample passes through like in BeatDetector, not from 0
+            self.prev_filtered_value = sample
+        self.prev_filtered_value = low_pass_q16(self.prev_filtered_value, sample, alpha)
+        return self.prev_filtered_value
     
     def calculate_data(self):
-        threshold = (sum(self.buffer) / len(self.buffer)) * 1.03
-        print(threshold)
+        thresholds = self.thresholds
+        print(self.tracker.threshold)
         bpm_list = []
         last_peak_index = 0
         for i in range(1, len(self.buffer) -1):
-            if self.buffer[i] > self.buffer[i - 1] and self.buffer[i] > self.buffer[i + 1] and self.buffer[i] > threshold:
+            if self.buffer[i] >= self.buffer[i - 1] and self.buffer[i] > self.buffer[i + 1] and self.buffer[i] > thresholds[i]:
                 
                 if last_peak_index != 0:
                     index_diff = i - last_peak_index
                     if self.min_peak_distance < index_diff < self.max_peak_distance:
                         ppi_ms = index_diff * 4
                         
-                        bpm = round(60/(ppi_ms/1000))
+                        bpm = (60000 + ppi_ms // 2) // ppi_ms # round(60 / (ppi_ms / 1000))
                         bpm_list.append(bpm) # appending bpm, because sample buffer has 1000 samples. There might be ~3-4 valid peaks in the data.
                 last_peak_index = i  
                 
         if bpm_list:  # Check if there are any valid BPMs in the list
-            round_bpm = (round(sum(bpm_list) / len(bpm_list)))  # Calculate the average BPM for more accuracy
+            round_bpm = (sum(bpm_list) * 2 + len(bpm_list)) // (2 * len(bpm_list))  # Calculate the average BPM for more accuracy
             if 30 < round_bpm < 200: # varmistus vielä vaikka filtteröi jo ppi perusteella
                 self.bpm = round_bpm
                 print("BPM: ", self.bpm)
         else:
             print("No relevant peaks detected")
+    
+    # Adds a new interval to the window and updates the BPM from the running sum, no rescan.
+    def add_interval(self, ppi):
+        if self.window_count == len(self.window):
+            self.window_sum -= self.window[self.window_index] # drop the oldest interval
+        else:
+            self.window_count += 1
+        self.window[self.window_index] = ppi
+        self.window_sum += ppi
+        self.window_index = (self.window_index + 1) % len(self.window)
+        
+        bpm = (60000 * self.window_count + self.window_sum // 2) // self.window_sum # 60000 / mean ppi, rounded
+        if 30 < bpm < 200:
+            self.bpm = bpm
+            print("BPM: ", self.bpm)
+    
+    def reset(self):
+        self.bpm = None
+        self.start_up = True
+        self.dirty = False
+        self.buffer_index = 0
+        self.prev_filtered_value = 0
+        self.tracker.reset()
+        self.detector.reset()
+        self.window_index = 0
+        self.window_count = 0
+        self.window_sum = 0
+        self.samples.clear() # samples left over from the last measurement
+    
+    def enter(self):
+        self.reset()
+        self.tmr = Piotimer(mode=Piotimer.PERIODIC, freq=self.sample_rate, callback=self.read_adc) # sample timer on
+    
+    def leave(self):
+        if self.tmr:
+            self.tmr.deinit() # sample timer off
+            self.tmr = None
+        self.reset()
+    
+    def core0_sampling(self):
+        return self.tmr is not None
+    
     def draw(self):
         if self.start_up:
             
@@ -178,413 +1002,1025 @@ class HrMeasurement:
                 self.OLED.text(f"BPM: {self.bpm}", 30, 32, 1)
             self.OLED.show()  # Update the screen
     
-    def execute(self):
-        global state
-        
-        if self.fifo.has_data():
-            #sample = self.fifo.get()
-            sample = self.low_pass_filter(self.fifo.get())
+    # Runs everything the timer has sampled since the last call through the detector
+    def process_samples(self):
+        block = self.block
+        while True:
+            n = self.samples.drain_into(block)
+            if not n:
+                break
+            for i in range(n):
+                if self.sliding_window:
+                    ppi = self.detector.process(block[i])
+                    if ppi:
+                        self.add_interval(ppi)
+                        self.dirty = True # drawn once per beat by update()
+                else:
+                    sample = self.low_pass_filter(block[i])
 
-            self.buffer[self.buffer_index] = sample
-            self.buffer_index = (self.buffer_index + 1) % len(self.buffer)  # ring buffer
+                    self.buffer[self.buffer_index] = sample
+                    self.thresholds[self.buffer_index] = self.tracker.update(sample)
+                    self.buffer_index = (self.buffer_index + 1) % len(self.buffer)  # ring buffer
 
-            if self.buffer_index == 0: # ring buffer full
-                print("Buffer is full, processing data...")
-                self.calculate_data()  
-                self.buffer_index = 0
-                self.draw() # Need to call draw here to limit draw calls, else the fifo fills up.
-                
+                    if self.buffer_index == 0: # ring buffer full
+                        print("Buffer is full, processing data...")
+                        self.calculate_data()  
+                        self.buffer_index = 0
+                        self.dirty = True
+    
+    def update(self):
         if self.start_up: # First startup
             self.draw()
-            
-        if self.rotary_encoder.fifo.has_data(): # Rotary events
-            event = self.rotary_encoder.fifo.get()
-            if event == 2:
-                self.bpm = None
-                self.start_up = True
-                state = 0
+        elif self.dirty:
+            self.draw()
+            self.dirty = False
+    
+    def on_event(self, event):
+        global state
+        
+        if event == 2:
+            state = 0
                 
         
-class HrvAnalysis:
-    def __init__(self, rotary_encoder, history_obj):
+class HrvAnalysis(Screen):
+    def __init__(self, rotary_encoder, hw, history_obj, buffers, mqtt):
         
         self.rotary_encoder = rotary_encoder
-        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-        self.OLED = SSD1306_I2C(128, 64, self.i2c)
-        self.adc = ADC(Pin(26))
+        self.i2c = hw.i2c
+        self.OLED = hw.OLED
+        self.adc = hw.adc
         self.history = history_obj
+        self.mqtt = mqtt
+        self.hrv_topic = mqtt.publisher("HRV", store=True)
         
         self.samplerate = 250
         self.duration = 30
         self.capturelength = int(self.samplerate * self.duration)
-        self.samples = Fifo(32)
-        self.adcbuffer = array.array('H', [0] * self.capturelength)
+        self.samples = SpscRing(64) # filled by the timer interrupt
+        self.block = buffers.block
+        self.detector = BeatDetector(self.samplerate)
+        self.worker = CaptureWorker(self.adc, self.detector, self.samplerate) if DUAL_CORE else None
+        self.buffers = buffers
+        self.ppi_count = 0 # how many intervals are in buffers.ppi
+        self.corrected_count = 0 # how many corrected intervals are in buffers.scratch
+        self.artifacts = ArtifactFilter(self.add_corrected)
+        self.stats = HrvStats() # fed with the corrected intervals as they come
+        self.spectrum = SpectralHrv(buffers)
+        self.spectral = None # (LF, HF) power of the last capture
         self.index = 0
         self.signal_threshold = 2500
         self.tmr = None
         self.analysis_done = False
+        self.result = None # (mean PPI, mean HR, RMSSD, SDNN) of the last analysis
+        self.measurement = None # result waiting for the network task
+        self.dirty = False # countdown or result to draw
         self.count = 30
         self.counter = 0
-        self.led = Pin(22, Pin.OUT)
+        self.led = hw.led
         
     def reset(self):
+        self.stop_timer() # first, core 1 or the timer may still be using the detector and ring
         self.index = 0
         self.count = 30
         self.counter = 0
-        self.adcbuffer = array.array('H', [0] * self.capturelength)
-        self.samples = Fifo(32)
+        self.samples.clear() # drop leftover samples, the ring is reused
+        self.detector.reset()
+        self.reset_intervals()
         self.analysis_done = False
-        if self.tmr:
-            self.stop_timer()
+        self.result = None
+        self.spectral = None
+        self.measurement = None
+        self.dirty = False
         print("analysis reset")
         
     def adc_read(self, tid):
         x = self.adc.read_u16()
         self.samples.put(x)
         
-    def low_pass_filter(self, data, a=0.2):
-        last_value = data[0]
-        for i in range(1, len(data)):
-            filtered_value = a * data[i] + (1 - a) * last_value
-            data[i] = int(round(filtered_value))
-            last_value = data[i]
-        return data
+    def reset_intervals(self):
+        self.ppi_count = 0
+        self.corrected_count = 0
+        self.artifacts.reset()
+        self.stats.reset()
     
-    def peak_to_peak_intervals(self, data):
-        
-        threshold = (sum(data) / len(data)) * 1.03
-        peaks_ms_list = []
-        lastpeak = 0
-        for i in range(1, len(data) - 1):
-            if data[i] > data[i - 1] and data[i] > data[i + 1] and data[i] > threshold:
-                if lastpeak != 0:
-                    indexdiff = i - lastpeak
-                    if 100 < indexdiff < 400:
-                        peak_ms = indexdiff * 4
-                        peaks_ms_list.append(peak_ms)       
-                lastpeak = i
-        return peaks_ms_list
-    
-    def moving_average(self, data, window_size=3):
-        return [int(sum(data[i:i+window_size]) / window_size) for i in range(len(data) - window_size + 1)]
-    
-    def rmssd_calc(self, data):
-        total = 0
-        for i in range(len(data) -1):
-            total += (data[i+1] - data[i])**2
-        rmssd_round = round((total / (len(data) - 1))**0.5, 0)
-        return int(rmssd_round)
+    # Stores a new interval in buffers.ppi and passes it through the artifact filter, which
+    # calls add_corrected() with the corrected interval(s).
+    def add_interval(self, ppi):
+        if self.ppi_count >= len(self.buffers.ppi):
+            return
+        self.buffers.ppi[self.ppi_count] = ppi
+        self.ppi_count += 1
+        self.artifacts.add(ppi)
     
-    def sdnn_calc(self, data, meanPPI):
-        total = 0
-        for i in data:
-            total += (i - meanPPI)**2
-        sdnn = (total / (len(data) - 1))**0.5
-        sdnn_round = round(sdnn, 0)
-        return int(sdnn_round) 
+    def add_corrected(self, ppi):
+        if self.corrected_count >= len(self.buffers.scratch):
+            return
+        self.buffers.scratch[self.corrected_count] = ppi
+        self.corrected_count += 1
+        self.stats.add(ppi)
         
     def start_timer(self):
-        self.tmr = Piotimer(freq=self.samplerate, mode=Piotimer.PERIODIC, callback=self.adc_read)
+        if self.worker:
+            self.worker.start(self.capturelength)
+        else:
+            self.tmr = Piotimer(freq=self.samplerate, mode=Piotimer.PERIODIC, callback=self.adc_read)
         
     def stop_timer(self):
+        if self.worker:
+            self.worker.stop()
         if self.tmr:
             self.tmr.deinit()
             self.tmr = None
     
-    def connectMQTT(self):
-        mqtt_client=MQTTClient("", "192.168.50.253", 21884)
-        mqtt_client.connect(clean_session=True)
-        print("Connected to mqtt broker")
-        return mqtt_client
-    
-    def execute(self):
-        
-        global state
-        
-        if self.analysis_done:
-            if self.rotary_encoder.fifo.has_data():
-                event = self.rotary_encoder.fifo.get() # Get the first event in fifo
-                if event == 2:
-                    self.reset()
-                    state = 0
-            return
-        
+    def draw_countdown(self):
         self.OLED.fill(0)
         self.OLED.text("Measuring for", 0, 0, 1)
         self.OLED.text(f"{self.count} seconds", 0, 16, 1)
         self.OLED.text("Please wait", 0, 32, 1)
         self.OLED.show()
-        
+    
+    def draw_error(self):
+        self.OLED.fill(0)
+        self.OLED.text("Error", 0, 0, 1)
+        self.OLED.text("Please try again", 0, 10, 1)
+        self.OLED.show()
+    
+    def draw_result(self):
+        if self.result is None:
+            self.draw_error()
+            return
+        meanPPI, meanHR, rmssd_value, sdnn_value = self.result
+        self.OLED.fill(0)
+        self.OLED.text(f"HRV Result:", 0, 0, 1)
+        self.OLED.text(f"MEAN PPI:{meanPPI} ms", 0, 10, 1)
+        self.OLED.text(f"MEAN HR:{meanHR} BPM", 0, 20, 1)
+        self.OLED.text(f"RMSSD:{rmssd_value} ms", 0, 30, 1)
+        self.OLED.text(f"SDNN:{sdnn_value} ms", 0, 40, 1)
+        if self.spectral:
+            self.OLED.text(f"LF/HF:{self.lf_hf_text()}", 0, 50, 1)
+        self.OLED.show()
+    
+    def lf_hf_text(self):
+        ratio = SpectralHrv.ratio(*self.spectral)
+        return f"{ratio // 100}.{ratio % 100:02d}"
+    
+    # Starts a self.duration second capture. Samples are handled by capture_step().
+    def start_capture(self):
+        self.reset()
+        self.dirty = True
         self.start_timer()
-        
-        while self.index < len(self.adcbuffer):
-            if not self.samples.empty():
-                x = self.samples.get()
-                self.adcbuffer[self.index] = x
+    
+    # Runs the samples that have arrived through the beat detector. The peak-to-peak intervals (ms)
+    # go to buffers.ppi, the corrected ones to buffers.scratch and self.stats, all ready as soon as
+    # the last sample is in. Returns True once, when the capture has just finished.
+    def capture_step(self):
+        if self.index >= self.capturelength:
+            return False
+        
+        if self.worker:
+            self.collect_intervals()
+        block = self.block
+        while self.index < self.capturelength:
+            n = self.samples.drain_into(block)
+            if not n:
+                break
+            for i in range(n):
+                ppi = self.detector.process(block[i])
+                if ppi:
+                    self.add_interval(ppi)
                 self.index += 1
-            # Handle the counter
+                # Handle the counter
                 self.counter += 1
-            
-            if self.counter >= 250:
-                self.counter = 0
-                if self.count > 0:
-                    self.count -= 1
-                    self.OLED.fill(0)
-                    self.OLED.text("Measuring for", 0, 0, 1)
-                    self.OLED.text(f"{self.count} seconds", 0, 16, 1)
-                    self.OLED.text("Please wait", 0, 32, 1)
-                    self.OLED.show()     
+                
+                if self.counter >= 250:
+                    self.counter = 0
+                    if self.count > 0:
+                        self.count -= 1
+                        self.dirty = True
+                if self.index >= self.capturelength:
+                    break
                     
+        if self.index < self.capturelength:
+            return False
         self.stop_timer()
-        
-        filtered_signal = self.low_pass_filter(self.adcbuffer)
-        peak_to_peak = self.peak_to_peak_intervals(filtered_signal)
-        smoothed_peaks = self.moving_average(peak_to_peak)
-        print(peak_to_peak)
-        print(smoothed_peaks)
-        
-        if len(smoothed_peaks) >= 3:
-            meanPPI = sum(smoothed_peaks) / len(smoothed_peaks) if smoothed_peaks else 0# scaled to ms #
-            meanHR = round(60 * 1000 / meanPPI, 0) if smoothed_peaks else 0
-            rmssd_value = self.rmssd_calc(smoothed_peaks)
-            sdnn_value = self.sdnn_calc(smoothed_peaks, meanPPI) # scaled to ms #
+        self.artifacts.flush()
+        print(f"{self.ppi_count} intervals, {self.artifacts.corrected()} corrected "
+              f"({self.artifacts.missed} missed, {self.artifacts.extra} extra, {self.artifacts.replaced} replaced)")
+        if self.ppi_count:
+            self.history.archive.add_session(time.time(), self.buffers.ppi[:self.ppi_count])
+        self.spectral = self.spectrum.analyse(self.buffers.scratch, self.corrected_count)
+        if self.spectral:
+            print(f"LF: {self.spectral[0]} ms2, HF: {self.spectral[1]} ms2, LF/HF: {self.lf_hf_text()}")
+        return True
+    
+    # Dual core: core 1 samples and detects the beats, here the intervals are only collected
+    def collect_intervals(self):
+        worker = self.worker
+        intervals = worker.intervals
+        finished = worker.idle() # read first, the last intervals are in the ring by then
+        while not intervals.empty():
+            self.add_interval(intervals.get())
+        count = self.duration - worker.index // self.samplerate
+        if count != self.count:
+            self.count = count
+            self.dirty = True
+        if finished:
+            self.index = self.capturelength
+            if worker.late or intervals.dropped:
+                print(f"core 1 since boot: {worker.late} late samples, {intervals.dropped} intervals dropped")
+    
+    # Results of a finished capture: shown, saved to history and queued for the network task
+    def finish(self):
+        if self.corrected_count >= 3:
+            meanPPI = self.stats.mean_ppi()
+            meanHR = self.stats.mean_hr()
+            rmssd_value = self.stats.rmssd()
+            sdnn_value = self.stats.sdnn()
         
             print(f"mean PPI: {meanPPI}, mean hr: {meanHR}, rmssd: {rmssd_value}, sdnn: {sdnn_value}")
-        
-            self.OLED.fill(0)
-            self.OLED.text(f"HRV Result:", 0, 0, 1)
-            self.OLED.text(f"MEAN PPI:{round(meanPPI)} ms", 0, 10, 1)
-            self.OLED.text(f"MEAN HR:{round(meanHR)} BPM", 0, 20, 1)
-            self.OLED.text(f"RMSSD:{rmssd_value} ms", 0, 30, 1)
-            self.OLED.text(f"SDNN:{sdnn_value} ms", 0, 40, 1)
-            self.OLED.show()
+            self.result = (meanPPI, meanHR, rmssd_value, sdnn_value)
             
             #SAVE DATA THROUGH HISTORY CLASS FUNCTION!
             self.history.save_measurement(meanPPI, meanHR, rmssd_value, sdnn_value)
             
-            measurement = {
+            self.measurement = {
                 "mean_hr" : meanHR,
                 "mean_ppi" : meanPPI,
                 "rmssd" : rmssd_value,
                 "sdnn" : sdnn_value
                 }
-            
+            if self.spectral:
+                self.measurement["lf"], self.measurement["hf"] = self.spectral
+                self.measurement["lf_hf"] = SpectralHrv.ratio(*self.spectral) / 100
+        
+        self.analysis_done = True
+        self.dirty = True
+        diagnostics.collect()
+    
+    # Called by the network task: publishes the last result if there is one waiting
+    def send_pending(self):
+        if self.measurement is None:
+            return
+        message = ujson.dumps(self.measurement)
+        if self.hrv_topic.publish(message):
+            print(f"Sending to MQTT: HRV -> {message}")      
+        else:
+            print("No MQTT connection, HRV result saved to the outbox")
+        self.measurement = None
+    
+    def enter(self):
+        self.mqtt.start() # WLAN and MQTT come up while the capture runs
+        self.start_capture()
+    
+    def core0_sampling(self): # the Piotimer is only used without DUAL_CORE
+        return self.tmr is not None
+    
+    def leave(self):
+        self.reset()
+    
+    def process_samples(self):
+        if self.capture_step():
+            self.finish()
+    
+    def update(self):
+        if self.dirty:
+            self.dirty = False
+            if self.analysis_done:
+                self.draw_result()
+            else:
+                self.draw_countdown()
+    
+    def on_event(self, event):
+        global state
+        
+        if event == 2: # back to the menu, also cancels a capture in progress
+            state = 0
+        
+# Messages that could not be sent, kept on flash until the broker is reachable again. It holds
+# at most max_messages; when full the oldest message is dropped. One JSON line per message,
+# so storing one is an append and only sending or dropping rewrites the file.
+class Outbox:
+    def __init__(self, filename="outbox.json", max_messages=50, batch_size=5):
+        self.filename = filename
+        self.max_messages = max_messages
+        self.batch_size = batch_size # messages sent per flush() call
+        self.messages = [] # [topic, msg], oldest first
+        self.watchers = {} # topic -> callback(msg, sent) when a message leaves the outbox
+        skipped = 0
+        try:
+            with open(self.filename, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try: # a line cut short by a power loss only loses that message
+                        topic, msg = ujson.loads(line)
+                        self.messages.append([topic, msg])
+                    except (ValueError, TypeError):
+                        skipped += 1
+        except OSError:
+            pass
+        trimmed = len(self.messages) > self.max_messages
+        if trimmed:
+            self.messages = self.messages[-self.max_messages:]
+        if skipped or trimmed: # rewritten, put() would append to a line that was cut short
+            self.save()
+        if skipped:
+            print(f"Skipped {skipped} damaged messages in the outbox")
+        if self.messages:
+            print(f"{len(self.messages)} messages in the outbox")
+    
+    def __len__(self):
+        return len(self.messages)
+    
+    # Writes a new file and renames it over the old one, so a power loss keeps one of the two
+    def save(self):
+        temp = self.filename + ".tmp"
+        with open(temp, "w") as f:
+            for item in self.messages:
+                f.write(ujson.dumps(item) + "\n")
+        os.rename(temp, self.filename)
+    
+    def watch(self, topic, callback):
+        self.watchers[topic] = callback
+    
+    def left(self, topic, msg, sent):
+        callback = self.watchers.get(topic)
+        if callback:
+            callback(msg, sent)
+    
+    def put(self, topic, msg):
+        self.messages.append([topic, msg])
+        if len(self.messages) > self.max_messages:
+            dropped = self.messages.pop(0)
+            print(f"Outbox full, dropped the oldest {dropped[0]} message")
+            self.save()
+            self.left(dropped[0], dropped[1], False)
+        else:
+            with open(self.filename, "a") as f:
+                f.write(ujson.dumps([topic, msg]) + "\n")
+    
+    # Publishes up to batch_size messages with publish(topic, msg), stopping at the first one
+    # that fails. Returns how many were sent.
+    def flush(self, publish):
+        sent = 0
+        for topic, msg in self.messages[:self.batch_size]:
+            if not publish(topic, msg):
+                break
+            sent += 1
+        if sent:
+            done = self.messages[:sent]
+            self.messages = self.messages[sent:]
+            self.save()
+            print(f"Sent {sent} messages from the outbox, {len(self.messages)} left")
+            for topic, msg in done:
+                self.left(topic, msg, True)
+        return sent
+
+# The WLAN connection, brought up the first time something needs the network. connect() never
+# waits: the first call starts connecting, later calls report whether it is up, so the menu
+# shows right away with or without Wi-Fi.
+class Wlan:
+    def __init__(self, ssid, password):
+        self.ssid = ssid
+        self.password = password
+        self.wlan = None
+        self.up = False
+    
+    def connect(self):
+        if self.wlan is None:
+            import network
+            self.wlan = network.WLAN(network.STA_IF)
+            self.wlan.active(True)
+            self.wlan.connect(self.ssid, self.password)
+            print("Connecting to WLAN...")
+        if self.wlan.isconnected():
+            if not self.up:
+                print("Connection successful. Pico IP:", self.wlan.ifconfig()[0])
+                self.up = True
+            return True
+        if self.wlan.status() < 0: # wrong password, no AP found or failed: try again
+            self.wlan.connect(self.ssid, self.password)
+        self.up = False
+        return False
+
+# The one MQTT session of the app. It connects when it can, pings the broker within the
+# keepalive time, reconnects with exponential backoff after an error and resubscribes
+# everything. The rest of the app only holds publisher and subscription handles. Messages of
+# publishers made with store=True go to the outbox when there is no connection and are sent,
+# oldest first, once it is back. Nothing touches the network until start() is called by the
+# first screen that needs it (or at boot when the outbox has messages to send). While a timer
+# samples on core 0 it is `paused`: an open session is used, but no blocking connect is tried.
+# A connect blocks the event loop, at most connect_timeout when the broker doesn't answer.
+class MqttConnection:
+    def __init__(self, broker_ip, port, outbox, wlan, keepalive=60, min_backoff_ms=1000, max_backoff_ms=60000,
+                 connect_timeout=1):
+        self.broker_ip = broker_ip
+        self.port = port
+        self.keepalive = keepalive # seconds, the broker drops us after 1.5x this without traffic
+        self.connect_timeout = connect_timeout # seconds, also for later writes on the socket
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.backoff_ms = min_backoff_ms
+        self.client = None
+        self.retry_at = time.ticks_ms() # earliest time for the next connect attempt
+        self.last_sent = 0 # ticks_ms of the last packet, for keepalive
+        self.subscriptions = {} # topic -> callback(topic, msg)
+        self.outbox = outbox
+        self.wlan = wlan
+        self.started = False
+        self.paused = False # no new connections, connect() can block for seconds
+    
+    def start(self):
+        if not self.started:
+            print("Starting the network")
+            self.started = True
+    
+    def publisher(self, topic, store=False):
+        return MqttPublisher(self, topic, store)
+    
+    def subscribe(self, topic, callback):
+        self.subscriptions[topic] = callback
+        if self.client:
             try:
-                mqtt_client=self.connectMQTT()
+                self.client.subscribe(topic)
             except Exception as e:
-                print(f"Failed to connect to MQTT: {e}")
-                self.OLED.fill(0)
-                self.OLED.text("Error", 0, 0, 1)
-                self.OLED.text("Please try again", 0, 10, 1)
-                self.OLED.show()
+                self.drop(e)
+        return MqttSubscription(self, topic)
+    
+    def connected(self):
+        return self.client is not None
+    
+    # Returns True when there is a session, connecting first if the WLAN is up and the backoff
+    # allows it
+    def connect(self):
+        if self.client:
+            return True
+        if not self.started or self.paused or not self.wlan.connect():
+            return False
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.retry_at) < 0:
+            return False
+        try:
+            from umqtt.simple import MQTTClient
+            client = MQTTClient("", self.broker_ip, self.port, keepalive=self.keepalive)
+            client.set_callback(self.on_message)
+            client.connect(clean_session=True, timeout=self.connect_timeout)
+            for topic in self.subscriptions:
+                client.subscribe(topic)
+        except Exception as e:
+            print(f"Failed to connect to MQTT: {e}, retry in {self.backoff_ms} ms")
+            self.retry_at = time.ticks_add(now, self.backoff_ms)
+            self.backoff_ms = min(self.backoff_ms * 2, self.max_backoff_ms)
+            return False
+        print("Connected to mqtt broker")
+        self.client = client
+        self.backoff_ms = self.min_backoff_ms
+        self.last_sent = now
+        return True
+    
+    # Closes a broken session; the next connect() waits out the backoff
+    def drop(self, e):
+        print(f"MQTT connection lost: {e}")
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+        self.client = None
+        self.retry_at = time.ticks_add(time.ticks_ms(), self.backoff_ms)
+    
+    # True if the message went to the broker. With store=True a message that didn't is put
+    # in the outbox, behind the ones already waiting there so the order is kept.
+    def publish(self, topic, msg, store=False):
+        if store and len(self.outbox) and self.connect():
+            self.outbox.flush(self.send)
+        if (not store or not len(self.outbox)) and self.send(topic, msg):
+            return True
+        if store:
+            self.outbox.put(topic, msg)
+        return False
+    
+    def send(self, topic, msg):
+        if not self.connect():
+            return False
+        try:
+            self.client.publish(topic, msg)
+        except Exception as e:
+            self.drop(e)
+            return False
+        self.last_sent = time.ticks_ms()
+        return True
+    
+    def on_message(self, topic, msg):
+        callback = self.subscriptions.get(topic.decode() if isinstance(topic, bytes) else topic)
+        if callback:
             try:
-                topic = "HRV"
-                message = ujson.dumps(measurement)
-                mqtt_client.publish(topic, message)
-                print(f"Sending to MQTT: {topic} -> {message}")      
-            except Exception as e:
-                print(f"Failed to send MQTT message: {e}")
-                self.OLED.fill(0)
-                self.OLED.text("Error", 0, 0, 1)
-                self.OLED.text("Please try again", 0, 10, 1)
-                self.OLED.show()
-            
-            gc.collect()
-            
-            self.analysis_done = True
-        
+                callback(topic, msg)
+            except Exception as e: # a bad message or a failed flash write is not a network error
+                print(f"MQTT message on {topic} failed: {e}")
+    
+    # Called by the network task: keeps the session up and hands incoming messages to the
+    # subscribers
+    def poll(self):
+        if not self.connect():
+            return
+        try:
+            if time.ticks_diff(time.ticks_ms(), self.last_sent) >= self.keepalive * 500:
+                self.client.ping()
+                self.last_sent = time.ticks_ms()
+            self.client.check_msg()
+        except Exception as e:
+            self.drop(e)
+            return
+        if len(self.outbox):
+            self.outbox.flush(self.send)
+
+class MqttPublisher:
+    def __init__(self, connection, topic, store=False):
+        self.connection = connection
+        self.topic = topic
+        self.store = store # keep unsent messages in the outbox
+    
+    # True if the message went to the broker
+    def publish(self, msg):
+        return self.connection.publish(self.topic, msg, self.store)
+
+class MqttSubscription:
+    def __init__(self, connection, topic):
+        self.connection = connection
+        self.topic = topic
+    
+    # umqtt.simple has no unsubscribe, the messages are just not passed on any more
+    def cancel(self):
+        self.connection.subscriptions.pop(self.topic, None)
+
+# Sends RRI data to Kubios over MQTT and matches each reply to its request by id, so several
+# requests can be in flight at once. callback(request_id, analysis) gets the analysis dict of
+# each reply, or None if the request failed, had no reply before its deadline or went to the
+# outbox. Requests in the outbox have no deadline until the outbox sends them, even after a
+# reboot; one the full outbox drops is forgotten. poll() is called by the network task and
+# never blocks.
+class KubiosClient:
+    def __init__(self, mqtt, callback, timeout_ms=30000):
+        self.timeout_ms = timeout_ms
+        self.callback = callback
+        self.request_topic = mqtt.publisher("kubios-request", store=True)
+        self.response = mqtt.subscribe("kubios-response", self.on_message)
+        self.next_id = time.time() % 1000000 * 100 # differs between boots, stays a small int
+        self.outgoing = [] # (id, message) not published yet
+        self.pending = {} # id -> deadline in ticks_ms, None while it is in the outbox
+        for topic, msg in mqtt.outbox.messages:
+            if topic == "kubios-request":
+                request_id = ujson.loads(msg)["id"]
+                self.pending[request_id] = None
+                self.next_id = max(self.next_id, request_id) # the clock may not be set after a reboot
+        mqtt.outbox.watch("kubios-request", self.on_outbox)
+    
+    def is_queued(self, request_id):
+        return request_id in self.pending and self.pending[request_id] is None
+    
+    # Queues a request and returns its id
+    def request(self, rri, analysis_type="readiness"):
+        self.next_id += 1
+        request_id = self.next_id
+        message = ujson.dumps({
+            "id" : request_id,
+            "type" : "RRI",
+            "data" : rri,
+            "analysis": { "type": analysis_type }
+            })
+        self.outgoing.append((request_id, message))
+        self.pending[request_id] = time.ticks_add(time.ticks_ms(), self.timeout_ms)
+        return request_id
+    
+    def on_message(self, topic, msg):
+        try:
+            data = ujson.loads(msg)
+            request_id = data["id"]
+            analysis = data["data"]["analysis"] if data["data"].get("status", "ok") == "ok" else None
+        except (ValueError, KeyError, TypeError):
+            print(f"Unexpected Kubios reply: {msg}")
+            return
+        if request_id not in self.pending:
+            print(f"Kubios reply {request_id} matches no pending request") # timed out already
+            return
+        del self.pending[request_id]
+        self.callback(request_id, analysis)
+    
+    # A request left the outbox: a sent one now waits for its reply like any other, a dropped
+    # one will never get a reply
+    def on_outbox(self, msg, sent):
+        request_id = ujson.loads(msg)["id"]
+        if request_id not in self.pending:
+            return
+        if sent:
+            self.pending[request_id] = time.ticks_add(time.ticks_ms(), self.timeout_ms)
         else:
-            self.OLED.fill(0)
-            self.OLED.text("Error", 0, 0, 1)
-            self.OLED.text("Please try again", 0, 10, 1)
-            self.OLED.show()
-            
-            gc.collect()
-        
-            self.analysis_done = True
-        
-class Kubios:
-    def __init__(self, rotary_encoder, history_obj, HrvAnalysis):
+            print(f"Kubios request {request_id} dropped from the outbox")
+            del self.pending[request_id]
+    
+    def fail(self, request_id):
+        if request_id in self.pending:
+            del self.pending[request_id]
+            self.callback(request_id, None)
+    
+    # Replies come in through the MQTT connection, this sends the queued requests and
+    # expires the ones past their deadline
+    def poll(self):
+        if not self.pending:
+            return
+        while self.outgoing:
+            request_id, message = self.outgoing.pop(0)
+            if self.request_topic.publish(message):
+                print(f"Sending to MQTT: kubios-request -> {message}")
+            else:
+                print(f"No MQTT connection, Kubios request {request_id} saved to the outbox")
+                self.pending[request_id] = None
+                self.callback(request_id, None)
+        
+        now = time.ticks_ms()
+        for request_id in list(self.pending):
+            deadline = self.pending[request_id]
+            if deadline is not None and time.ticks_diff(now, deadline) >= 0:
+                print(f"Kubios request {request_id} timed out")
+                self.fail(request_id)
+
+class Kubios(Screen):
+    def __init__(self, rotary_encoder, hw, history_obj, HrvAnalysis, buffers, mqtt):
         self.rotary_encoder = rotary_encoder
         self.HrvAnalysis = HrvAnalysis
-        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-        self.OLED = SSD1306_I2C(128, 64, self.i2c)
-        self.adc = ADC(Pin(26))
+        self.buffers = buffers
+        self.i2c = hw.i2c
+        self.OLED = hw.OLED
+        self.adc = hw.adc
         self.history = history_obj
         
-        self.ssid = "KME751_Group_5"
-        self.password = "Nakkivene1"
-        self.broker_ip = "192.168.50.253"
-        self.port = 21884
         self.tmr = None
-        self.connect_wlan()
-            
-        
-        # Function to connect to WLAN
-    def connect_wlan(self):
-        # Connecting to the group WLAN
-        wlan = network.WLAN(network.STA_IF)
-        wlan.active(True)
-        wlan.connect(self.ssid, self.password)
-
-        # Attempt to connect once per second
-        while wlan.isconnected() == False:
-            print("Connecting... ")
-            self.OLED.fill(0)
-            self.OLED.text("Connecting to", 0, 0, 1)
-            self.OLED.text("WLAN", 0, 10, 1)
-            self.OLED.show()
-            time.sleep(1)
-
-        # Print the IP address of the Pico
-        print("Connection successful. Pico IP:", wlan.ifconfig()[0])
-        
-    def sub_cb(self, topic, msg):
-        data = ujson.loads(msg)
+        self.client = KubiosClient(mqtt, self.on_result)
+        self.request_id = None # request of the measurement on screen
+        self.analysis = None
+        self.failed = False
+        self.queued = False # request went to the outbox, the reply will go to history
+        self.dirty = False
+        self.mqtt = mqtt
+        
+    # Reply from KubiosClient. A reply to an earlier request (the user has moved on since) is
+    # still saved to history, only the current one is shown.
+    def on_result(self, request_id, analysis):
+        if analysis is None:
+            if request_id == self.request_id:
+                self.request_id = None
+                self.queued = self.client.is_queued(request_id)
+                self.failed = not self.queued
+                self.dirty = True
+            return
         
+        self.history.save_measurement(round(analysis["mean_rr_ms"]),
+                              round(analysis["mean_hr_bpm"]),
+                              round(analysis["rmssd_ms"]),
+                              round(analysis["sdnn_ms"]))   
+        if request_id == self.request_id:
+            self.request_id = None
+            self.analysis = analysis
+            self.dirty = True
+    
+    def draw_result(self):
+        analysis = self.analysis
         self.OLED.fill(0)   
-        self.OLED.text(f'MEAN HR: {str(round(data["data"]["analysis"]["mean_hr_bpm"]))}' , 0, 0, 1)
-        self.OLED.text(f'MEAN PPI: {str(round(data["data"]["analysis"]["mean_rr_ms"]))}' , 0, 10, 1)
-        self.OLED.text(f'RMSSD: {str(round(data["data"]["analysis"]["rmssd_ms"]))}' , 0, 20, 1)
-        self.OLED.text(f'SDNN: {str(round(data["data"]["analysis"]["sdnn_ms"]))}' , 0, 30, 1)
-        self.OLED.text(f'SNS: {data["data"]["analysis"]["sns_index"]:.2f}' , 0, 40, 1)
-        self.OLED.text(f'PNS: {data["data"]["analysis"]["pns_index"]:.2f}' , 0, 50, 1)
+        self.OLED.text(f'MEAN HR: {str(round(analysis["mean_hr_bpm"]))}' , 0, 0, 1)
+        self.OLED.text(f'MEAN PPI: {str(round(analysis["mean_rr_ms"]))}' , 0, 10, 1)
+        self.OLED.text(f'RMSSD: {str(round(analysis["rmssd_ms"]))}' , 0, 20, 1)
+        self.OLED.text(f'SDNN: {str(round(analysis["sdnn_ms"]))}' , 0, 30, 1)
+        self.OLED.text(f'SNS: {analysis["sns_index"]:.2f}' , 0, 40, 1)
+        self.OLED.text(f'PNS: {analysis["pns_index"]:.2f}' , 0, 50, 1)
         self.OLED.show()
-
-        self.history.save_measurement(round(data["data"]["analysis"]["mean_rr_ms"]),
-                              round(data["data"]["analysis"]["mean_hr_bpm"]),
-                              round(data["data"]["analysis"]["rmssd_ms"]),
-                              round(data["data"]["analysis"]["sdnn_ms"]))   
-                
-    def connect_mqtt(self):
-        mqtt_client=MQTTClient("", self.broker_ip, self.port)
-        mqtt_client.set_callback(self.sub_cb)
-        mqtt_client.connect(clean_session=True)
-        mqtt_client.subscribe("kubios-response")
-        print("Connected to mqtt broker")
-        return mqtt_client
-            
     
-    def draw(self):
+    def draw_waiting(self):
         self.OLED.fill(0)
-        self.OLED.text("Measuring for", 0, 0, 1)
-        self.OLED.text(f"{self.HrvAnalysis.count} seconds", 0, 16, 1)
-        self.OLED.text("Please wait", 0, 32, 1)
+        self.OLED.text("Waiting for", 0, 0, 1)
+        self.OLED.text("Kubios...", 0, 10, 1)
         self.OLED.show()
-        
-    def execute(self):
-        global state
-        
-        if self.HrvAnalysis.analysis_done:
-            if self.rotary_encoder.fifo.has_data():
-                event = self.rotary_encoder.fifo.get() # Get the first event in fifo
-                if event == 2:
-                    self.HrvAnalysis.reset()
-                    state = 0
-            return
-        
-        self.draw()
-        
-        self.HrvAnalysis.start_timer()
-        
-        while self.HrvAnalysis.index < len(self.HrvAnalysis.adcbuffer):
-            if not self.HrvAnalysis.samples.empty():
-                x = self.HrvAnalysis.samples.get()
-                self.HrvAnalysis.adcbuffer[self.HrvAnalysis.index] = x
-                self.HrvAnalysis.index += 1
-                self.HrvAnalysis.counter += 1
-                
-            if self.HrvAnalysis.counter >= 250:
-                self.HrvAnalysis.counter = 0
-                if self.HrvAnalysis.count > 0:
-                    self.HrvAnalysis.count -= 1
-                    self.OLED.fill(0)
-                    self.OLED.text("Measuring for", 0, 0, 1)
-                    self.OLED.text(f"{self.HrvAnalysis.count} seconds", 0, 16, 1)
-                    self.OLED.text("Please wait", 0, 32, 1)
-                    self.OLED.show()
+    
+    def draw_queued(self):
+        self.OLED.fill(0)
+        self.OLED.text("No connection", 0, 0, 1)
+        self.OLED.text("Request saved,", 0, 16, 1)
+        self.OLED.text("the result goes", 0, 26, 1)
+        self.OLED.text("to History", 0, 36, 1)
+        if self.HrvAnalysis.spectral:
+            self.OLED.text(f"LF/HF:{self.HrvAnalysis.lf_hf_text()}", 0, 50, 1)
+        self.OLED.show()
+    
+    def enter(self):
+        self.mqtt.start()
+        self.failed = False
+        self.queued = False
+        self.analysis = None
+        self.HrvAnalysis.start_capture()
+    
+    def leave(self):
+        self.HrvAnalysis.reset()
+        self.request_id = None # a late reply still goes to history
+    
+    def core0_sampling(self):
+        return self.HrvAnalysis.core0_sampling()
+    
+    def process_samples(self):
+        if self.HrvAnalysis.capture_step():
+            intervals = list(self.buffers.scratch[:self.HrvAnalysis.corrected_count]) # ujson needs a list
+            print(intervals)
             
-        self.HrvAnalysis.stop_timer()
-        
-        filtered_signal = self.HrvAnalysis.low_pass_filter(self.HrvAnalysis.adcbuffer)
-        peak_to_peak = self.HrvAnalysis.peak_to_peak_intervals(filtered_signal)
-        smoothed_peaks = self.HrvAnalysis.moving_average(peak_to_peak)
-        print(smoothed_peaks)
-        
-        sendtokubios = {
-            "id" : 123,
-            "type" : "RRI",
-            "data" : smoothed_peaks,
-            "analysis": { "type": "readiness" }
-            }
+            self.request_id = self.client.request(intervals)
+            self.HrvAnalysis.analysis_done = True
+            self.dirty = True
+            diagnostics.collect()
+    
+    def update(self):
+        if not self.HrvAnalysis.analysis_done:
+            self.HrvAnalysis.update() # countdown
+        elif self.dirty:
+            self.dirty = False
+            if self.failed:
+                self.HrvAnalysis.draw_error()
+            elif self.queued:
+                self.draw_queued()
+            elif self.analysis:
+                self.draw_result()
+            else:
+                self.draw_waiting()
+    
+    def on_event(self, event):
+        global state
         
+        if event == 2:
+            diagnostics.collect()
+            state = 0
+
+# PPI series are stored as the difference to the previous interval (the first one to 0),
+# zigzag-mapped to unsigned and written as varints: 7 bits per byte, high bit = more bytes.
+# Beat-to-beat differences are mostly under 64 ms, so an interval takes one byte.
+def encode_ppi(intervals):
+    data = bytearray()
+    prev = 0
+    for ppi in intervals:
+        delta = ppi - prev
+        prev = ppi
+        value = delta << 1 if delta >= 0 else ((-delta) << 1) - 1
+        while value >= 0x80:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+    return data
+
+def decode_ppi(data):
+    intervals = []
+    prev = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte & 0x80:
+            continue
+        prev += (value >> 1) if not value & 1 else -((value + 1) >> 1)
+        intervals.append(prev)
+        value = 0
+        shift = 0
+    return intervals
+
+# The raw PPI series of every HRV session, so old sessions can be analysed again later.
+# ppi.bin holds the encoded series back to back, ppi.idx one fixed-size row per session
+# with where its series is. Both are only ever appended to. tools/ppi_archive.py reads
+# them on a PC.
+class PpiArchive:
+    INDEX = "<IIHH" # time (s since epoch), offset in ppi.bin, length in bytes, intervals
+    
+    def __init__(self, filename="ppi.bin", index_filename="ppi.idx"):
+        self.filename = filename
+        self.index_filename = index_filename
+        self.row_size = struct.calcsize(self.INDEX)
         try:
-            mqtt_client=self.connect_mqtt()
-        except Exception as e:
-            print(f"Failed to connect to MQTT: {e}")
-            self.OLED.fill(0)
-            self.OLED.text("Error", 0, 0, 1)
-            self.OLED.text("Please try again", 0, 10, 1)
-            self.OLED.show()
-        
+            self.size = os.stat(self.filename)[6]
+            self.sessions = os.stat(self.index_filename)[6] // self.row_size
+        except OSError:
+            self.size = 0
+            self.sessions = 0
+    
+    def __len__(self):
+        return self.sessions
+    
+    def add_session(self, date, intervals):
+        data = encode_ppi(intervals)
+        with open(self.filename, "ab") as f:
+            f.write(data)
+        with open(self.index_filename, "ab") as f:
+            f.write(struct.pack(self.INDEX, date, self.size, len(data), len(intervals)))
+        self.size += len(data)
+        self.sessions += 1
+        print(f"PPI archive: session {self.sessions}, {len(intervals)} intervals in {len(data)} bytes")
+    
+    # (time, intervals) of session i, 0 = oldest
+    def read_session(self, i):
+        with open(self.index_filename, "rb") as f:
+            f.seek(i * self.row_size)
+            date, offset, length, count = struct.unpack(self.INDEX, f.read(self.row_size))
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            return date, decode_ppi(f.read(length))
+
+# Small least recently used cache. The keys are kept in use order in a list, which is cheap
+# enough for the handful of entries it is meant for.
+class LruCache:
+    def __init__(self, size=8):
+        self.size = size
+        self.items = {}
+        self.order = [] # least recently used first
+    
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.order.remove(key)
+            self.order.append(key)
+        return value
+    
+    def put(self, key, value):
+        if key in self.items:
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.items[self.order.pop(0)]
+        self.items[key] = value
+        self.order.append(key)
+    
+    def pop(self, key):
+        if key in self.items:
+            del self.items[key]
+            self.order.remove(key)
+    
+    def clear(self):
+        self.items = {}
+        self.order = []
+
+# One History entry. On flash and in the page cache it is a packed 12-byte row (Measurement.RECORD);
+# an object is only made for the record on screen and JSON only when the history is exported.
+class Measurement:
+    __slots__ = ("time", "ppi", "hr", "rmssd", "sdnn")
+    RECORD = "<IHHHH" # time (s since epoch), mean PPI, mean HR, RMSSD, SDNN
+    
+    def __init__(self, time, ppi, hr, rmssd, sdnn):
+        self.time = time
+        self.ppi = ppi
+        self.hr = hr
+        self.rmssd = rmssd
+        self.sdnn = sdnn
+    
+    @classmethod
+    def unpack(cls, row):
+        return cls(*struct.unpack(cls.RECORD, row))
+    
+    def pack(self):
+        # unsigned 16-bit fields, a value out of range is clamped rather than failing the save
+        values = [min(max(int(value), 0), 65535) for value in (self.ppi, self.hr, self.rmssd, self.sdnn)]
+        return struct.pack(self.RECORD, int(self.time), *values)
+    
+    def date(self):
+        measurement_time = time.localtime(self.time)
+        return f"{measurement_time[2]}/{measurement_time[1]}/{measurement_time[0]}"
+    
+    def to_dict(self):
+        return {"time": self.time, "date": self.date(), "ppi": self.ppi, "hr": self.hr,
+                "rmssd": self.rmssd, "sdnn": self.sdnn}
+
+# History records on flash: a small header and a fixed number of fixed-size record slots used
+# as a ring, like in the Fifo class. Saving writes one record and the header, nothing else is
+# rewritten, and when the ring is full the oldest record is overwritten. Only the header is
+# read at boot; records are read one page at a time, with the pages next to it, into a small
+# LRU cache, so RAM use doesn't grow with the history.
+class HistoryLog:
+    MAGIC = b"SLH1"
+    HEADER = "<4sHHHH" # magic, record size, slots, head (next slot to write), tail (oldest record)
+    
+    def __init__(self, filename="history.bin", capacity=1000, cache_size=8):
+        self.filename = filename
+        self.cache = LruCache(cache_size) # slot -> packed row
+        self.header_size = struct.calcsize(self.HEADER)
+        self.record_size = struct.calcsize(Measurement.RECORD)
+        self.slots = capacity + 1 # one slot stays free, head == tail only when empty
+        self.head = 0
+        self.tail = 0
         try:
-            
-            topic = "kubios-request"
-            message = ujson.dumps(sendtokubios)
-            mqtt_client.publish(topic, message)
-            print(f"Sending to MQTT: {topic} -> {message}")
-            
-        except Exception as e:
-            print(f"Failed to send MQTT message: {e}")
-            self.OLED.fill(0)
-            self.OLED.text("Error", 0, 0, 1)
-            self.OLED.text("Please try again", 0, 10, 1)
-            self.OLED.show()
-        
-        while True:
+            with open(self.filename, "rb") as f:
+                magic, record_size, slots, head, tail = struct.unpack(self.HEADER, f.read(self.header_size))
+        except Exception: # no log yet or a short header
+            magic = None
+        if magic == self.MAGIC and record_size == self.record_size:
+            if slots == self.slots:
+                self.head = head
+                self.tail = tail
+            else:
+                self.migrate(slots, head, tail)
+        else:
             try:
-                mqtt_client.wait_msg()
-            except Exception as e:
-                print(f"Error during wait: {e}")
-                self.OLED.fill(0)
-                self.OLED.text("Error", 0, 0, 1)
-                self.OLED.text("Please try again", 0, 10, 1)
-                self.OLED.show()
-                self.HrvAnalysis.analysis_done = True
-                time.sleep(1)
-            self.HrvAnalysis.analysis_done = True
-            break
-        
-            if self.rotary_encoder.fifo.has_data():
-                event = self.rotary_encoder.fifo.get()
-                if event == 2:
-                    gc.collect()
-                    break
-                    state = 0
-        
-        self.HrvAnalysis.analysis_done = True
-        
-class History:
-    def __init__(self, rotary_encoder):
+                os.rename(self.filename, self.filename + ".old") # unknown format, kept aside
+                print(f"{self.filename} not readable, moved to {self.filename}.old")
+            except OSError: # no log yet
+                pass
+            self.create()
+    
+    def __len__(self):
+        return (self.head - self.tail) % self.slots
+    
+    def create(self):
+        self.head = 0
+        self.tail = 0
+        self.cache.clear()
+        with open(self.filename, "wb") as f:
+            self.write_header(f)
+    
+    # The log was written with another capacity: the newest records that fit are copied to a
+    # log of this size, oldest first, one record at a time
+    def migrate(self, slots, head, tail):
+        count = (head - tail) % slots
+        keep = min(count, self.slots - 1)
+        self.head = keep
+        self.tail = 0
+        temp = self.filename + ".tmp"
+        with open(self.filename, "rb") as old, open(temp, "wb") as new:
+            self.write_header(new)
+            for i in range(count - keep, count):
+                old.seek(self.header_size + (tail + i) % slots * self.record_size)
+                new.write(old.read(self.record_size))
+        os.remove(self.filename)
+        os.rename(temp, self.filename)
+        print(f"History log resized from {slots - 1} to {self.slots - 1} records, {keep} kept")
+    
+    def write_header(self, f):
+        f.seek(0)
+        f.write(struct.pack(self.HEADER, self.MAGIC, self.record_size, self.slots, self.head, self.tail))
+    
+    # Writes the record first and the header after it, so a reset in between loses at most
+    # the new record
+    def append(self, measurement):
+        self.cache.pop(self.head)
+        with open(self.filename, "r+b") as f:
+            f.seek(self.header_size + self.head * self.record_size)
+            f.write(measurement.pack())
+            self.head = (self.head + 1) % self.slots
+            if self.head == self.tail: # full, the oldest record was overwritten
+                self.tail = (self.tail + 1) % self.slots
+            self.write_header(f)
+    
+    # Record i, 0 = oldest. On a cache miss records i - 1 and i + 1 are read too, they are
+    # the next pages the encoder can turn to.
+    def read(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError("history record out of range")
+        slot = (self.tail + i) % self.slots
+        row = self.cache.get(slot)
+        if row is None:
+            with open(self.filename, "rb") as f:
+                for j in (i - 1, i + 1, i): # i last, it is the most recently used
+                    if 0 <= j < len(self):
+                        row = self.read_slot(f, (self.tail + j) % self.slots)
+        return Measurement.unpack(row)
+    
+    def read_slot(self, f, slot):
+        row = self.cache.get(slot)
+        if row is None:
+            f.seek(self.header_size + slot * self.record_size)
+            row = f.read(self.record_size)
+            self.cache.put(slot, row)
+        return row
+    
+    # All records oldest first, read straight from the file without the cache
+    def records(self):
+        with open(self.filename, "rb") as f:
+            for i in range(len(self)):
+                f.seek(self.header_size + (self.tail + i) % self.slots * self.record_size)
+                yield Measurement.unpack(f.read(self.record_size))
+
+class History(Screen):
+    def __init__(self, rotary_encoder, hw):
         """
         TO-DO:
-            - Save actual data from measurements. 	[]
+            - Save actual data from measurements. 	[X]
             - Display the data.					 	[X]
-            - Erase data history 					[]
+            - Erase data history 					[X]
             - Add more TO-DO's...					[]
         """
         
         self.rotary_encoder = rotary_encoder
         
-        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-        self.OLED = SSD1306_I2C(128, 64, self.i2c)
+        self.i2c = hw.i2c
+        self.OLED = hw.OLED
         
-        self.max_save_data = 25
+        self.max_save_data = 2000
         self.current_page:int = 0
         self.last_page:int = 0
+        self.dirty = True
         
-        self.save_data:list = [] # create empty save_data variable.
-        self.initialize_json() #check if savedata.json exist. if not create new .json file inside root directory.
+        self.log = HistoryLog("history.bin", self.max_save_data)
+        self.archive = PpiArchive("ppi.bin", "ppi.idx") # raw intervals of every HRV session
+        self.import_json() # savedata.json of older versions goes into the log once
+        print(f"History: {len(self.log)}/{self.max_save_data} measurements")
             
     def clamp(self, i, min, max): 
         if i < min: 
@@ -594,62 +2030,66 @@ class History:
         else: 
             return i 
         
-    def initialize_json(self): 
+    def import_json(self): 
         try:
-            #IF savedata.json EXISTS => load it to our self.save_data!
-            with open("savedata.json", "r") as f: #with open("PATH", "r=READ") as VARIABLE
-                self.save_data = ujson.load(f) #loads json data and adds it to "save_data" -variable to keep it in sync for new entries. 
-                print("savedata.json file found.")
-        except:
-            #IF savedata.json does NOT exist => create new savedata.json in root!
-            new_data = ujson.dumps(self.save_data) #dump empty
-            with open("savedata.json", "w") as f: #with open("PATH", "w=WRITE") as VARIABLE
-                f.write(new_data)    
-            print("Save data not found. Created new savedata.json file in to root directory.")
+            with open("savedata.json", "r") as f:
+                save_data = ujson.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(save_data, list):
+            save_data = []
+        imported = 0
+        for entry in save_data:
+            try: # entries that don't look like the old format are left out, not fatal at boot
+                measurement = self.legacy_measurement(entry)
+            except (KeyError, ValueError, TypeError, AttributeError, OverflowError):
+                continue
+            self.log.append(measurement)
+            imported += 1
+        os.rename("savedata.json", "savedata.json.imported") # also with skipped entries, or they come back every boot
+        print(f"Imported {imported} measurements from savedata.json, skipped {len(save_data) - imported}")
+    
+    # One savedata.json entry: {"Date": "d/m/yyyy", "PPI": ..., "HR": ..., "rmssd": ..., "sdnn": ...}
+    def legacy_measurement(self, entry):
+        day, month, year = (int(part) for part in entry["Date"].split("/"))
+        if not (1 <= day <= 31 and 1 <= month <= 12 and year >= 2000):
+            raise ValueError("bad date")
+        date = time.mktime((year, month, day, 0, 0, 0, 0, 0))
+        values = [int(entry[key]) for key in ("PPI", "HR", "rmssd", "sdnn")]
+        return Measurement(date, *values)
     
     def erase_history(self):
-        self.save_data.clear()
-        
-        with open("savedata.json", "w") as f: #with open("PATH", "w=WRITE") as VARIABLE
-            ujson.dump(self.save_data, f)
-            print("Erased all history data.")
+        self.log.create()
+        print("Erased all history data.")
     
-    #creates a array obj of dictionary and appends it to our save_data variable and adds it to our savedata.json file.
+    # Appends one record to the history log
     def save_measurement(self, ppi, hr, rmssd, sdnn):
-        measurement_time = time.localtime()
-        date = f"{measurement_time[2]}/{measurement_time[1]}/{measurement_time[0]}"
-        
-        new_entry = {
-            "Date" 	: date,
-            "PPI" 	: ppi,
-            "HR" 	: hr,
-            "rmssd" : rmssd,
-            "sdnn" 	: sdnn
-            } 
-        
-        self.save_data.append(new_entry)
-        
-        #if maximum list dictionaries is reached, remove oldest data.
-        if(len(self.save_data) > self.max_save_data):
-            self.save_data.pop(0) #remove first data from json.
-
-        with open("savedata.json", "w") as f: #with open("PATH", "w=WRITE") as VARIABLE
-            ujson.dump(self.save_data, f)
-    
-        print(f"new .json data saved. slots: { len(self.save_data) }/{ self.max_save_data }")
+        self.log.append(Measurement(time.time(), ppi, hr, rmssd, sdnn))
+        self.dirty = True # shown right away if the History screen is open
+        print(f"measurement saved. slots: { len(self.log) }/{ self.max_save_data }")
+        
+    # Writes the whole history as a JSON list, one record at a time so it never is all in RAM
+    def export_json(self, filename="history_export.json"):
+        with open(filename, "w") as f:
+            f.write("[")
+            for i, measurement in enumerate(self.log.records()):
+                f.write(("," if i else "") + "\n" + ujson.dumps(measurement.to_dict()))
+            f.write("\n]\n")
+        print(f"Exported {len(self.log)} measurements to {filename}")
         
     def display_history(self, i):
-        self.OLED.text(str( self.save_data[i]["Date"] ) , 0, 12, 1)
-        self.OLED.text(f"HR: {str( self.save_data[i]['HR'] )}" , 0, 20, 1)
-        self.OLED.text(f"PPI: {str( self.save_data[i]['PPI'] )}" , 0, 28, 1)
-        self.OLED.text(f"rmssd: {str( self.save_data[i]['rmssd'] )}" , 0, 36, 1)
-        self.OLED.text(f"sdnn: {str( self.save_data[i]['sdnn'] )}" , 0, 44, 1)
+        measurement = self.log.read(i)
+        self.OLED.text(measurement.date() , 0, 12, 1)
+        self.OLED.text(f"HR: {measurement.hr}" , 0, 20, 1)
+        self.OLED.text(f"PPI: {measurement.ppi}" , 0, 28, 1)
+        self.OLED.text(f"rmssd: {measurement.rmssd}" , 0, 36, 1)
+        self.OLED.text(f"sdnn: {measurement.sdnn}" , 0, 44, 1)
         
     def draw(self, page):
         self.OLED.fill(0)  # turn off all leds
         
-        if len(self.save_data) > 0:
-            self.OLED.text("History (" + str(self.current_page+1) + "/" + str(len(self.save_data))  + ")", 0, 0, 1)
+        if len(self.log) > 0:
+            self.OLED.text("History (" + str(self.current_page+1) + "/" + str(len(self.log))  + ")", 0, 0, 1)
             self.display_history(page)
         else:
             self.OLED.text("History", 0, 0, 1)
@@ -658,54 +2098,217 @@ class History:
         self.OLED.text("Press to return", 0, 56, 1)
         self.OLED.show()  # Update the screen
         
-    def execute(self):
+    def enter(self):
+        self.dirty = True # there may be new measurements
+        
+    def on_event(self, event):
         global state
-
-        if self.rotary_encoder.fifo.has_data():
-            event = self.rotary_encoder.fifo.get() # Get the first event in fifo
-            
-            if event == 1 or event == -1:  #check if is rotation
-                self.last_page = self.current_page
-                self.current_page += event
-                
-                self.current_page = self.clamp(
-                    self.current_page,
-                    0,
-                    len(self.save_data)-1)
-                
-            if event == 2:
-                self.current_page = 0
-                state = 0
-                
-        self.draw(self.current_page)
         
+        if event == 1 or event == -1:  #check if is rotation
+            self.last_page = self.current_page
+            self.current_page += event
+            
+            self.current_page = self.clamp(
+                self.current_page,
+                0,
+                len(self.log)-1)
+            
+        if event == 2:
+            self.current_page = 0
+            state = 0
+        self.dirty = True
+    
+    def update(self):
+        if self.dirty:
+            self.draw(self.current_page)
+            self.dirty = False
+
+# Field diagnostics: dropped samples, the high-water marks of the sample rings, how long each
+# task step blocked the loop (a histogram per state) and garbage collection pauses.
+# In the REPL: diagnostics.report(). Once a screen has started the network, network_task also
+# publishes snapshot() to the "diagnostics" topic every interval_ms; a snapshot that is due
+# waits for the connection, older ones are not kept. Diagnostics never start the network.
+class Diagnostics:
+    BUCKETS_US = (1000, 2000, 5000, 10000, 20000, 50000, 100000) # upper bounds, then slower
+    STATE_NAMES = ("menu", "hr", "hrv", "kubios", "history")
+
+    def __init__(self, mqtt, rotary_encoder, interval_ms=60000):
+        self.topic = mqtt.publisher("diagnostics")
+        self.mqtt = mqtt
+        self.rotary_encoder = rotary_encoder
+        self.interval_ms = interval_ms
+        self.next_publish = time.ticks_add(time.ticks_ms(), interval_ms)
+        self.rings = [] # (name, SpscRing)
+        self.worker = None
+        buckets = len(self.BUCKETS_US) + 1
+        self.loop = [array.array('I', [0] * buckets) for _ in self.STATE_NAMES]
+        self.loop_max = array.array('I', [0] * len(self.STATE_NAMES)) # us
+        self.gc_count = 0
+        self.gc_total_us = 0
+        self.gc_max_us = 0
+        self.reported_drops = 0
+
+    def watch(self, name, ring):
+        self.rings.append((name, ring))
+
+    # One task step of `us` microseconds while the app was in `state`
+    def loop_time(self, state, us):
+        bucket = 0
+        for limit in self.BUCKETS_US:
+            if us < limit:
+                break
+            bucket += 1
+        self.loop[state][bucket] += 1
+        if us > self.loop_max[state]:
+            self.loop_max[state] = us
+
+    # gc.collect() with the pause recorded
+    def collect(self):
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+        self.gc_count += 1
+        self.gc_total_us += pause
+        if pause > self.gc_max_us:
+            self.gc_max_us = pause
+
+    def dropped(self):
+        total = self.rotary_encoder.fifo.dropped()
+        for name, ring in self.rings:
+            total += ring.dropped
+        return total
+
+    def snapshot(self):
+        loop = {}
+        loop_max = {}
+        for i, name in enumerate(self.STATE_NAMES):
+            loop[name] = list(self.loop[i])
+            loop_max[name] = self.loop_max[i] // 1000
+        dropped = {name: ring.dropped for name, ring in self.rings}
+        dropped["encoder"] = self.rotary_encoder.fifo.dropped()
+        data = {
+            "uptime_s": time.ticks_ms() // 1000, # ticks_ms counts from boot
+            "dropped": dropped,
+            "high_water": {name: ring.high_water for name, ring in self.rings},
+            "loop_buckets_ms": [limit // 1000 for limit in self.BUCKETS_US],
+            "loop": loop,
+            "loop_max_ms": loop_max,
+            "gc": {"count": self.gc_count, "total_ms": self.gc_total_us // 1000, "max_ms": self.gc_max_us // 1000},
+            "mem_free": gc.mem_free(),
+        }
+        if self.worker:
+            data["late"] = self.worker.late
+        return data
+
+    def report(self):
+        print(f"uptime {time.ticks_ms() // 1000} s, {gc.mem_free()} bytes free")
+        for name, ring in self.rings:
+            print(f"  {name:<10}{ring.dropped} dropped, high water {ring.high_water}/{ring.size - 1}")
+        print(f"  {'encoder':<10}{self.rotary_encoder.fifo.dropped()} dropped")
+        if self.worker:
+            print(f"  {'core 1':<10}{self.worker.late} late samples")
+        print(f"  {'gc':<10}{self.gc_count} collections, {self.gc_total_us // 1000} ms, max {self.gc_max_us // 1000} ms")
+        print("  loop ms   " + "".join(f"<{limit // 1000:<5}" for limit in self.BUCKETS_US) + "more   max")
+        for i, name in enumerate(self.STATE_NAMES):
+            counts = "".join(f"{count:<6}" for count in self.loop[i])
+            print(f"  {name:<10}{counts}{self.loop_max[i] // 1000}")
+
+    # Called by the network task
+    def poll(self):
+        dropped = self.dropped()
+        if dropped != self.reported_drops:
+            print(f"Samples dropped: {dropped} since boot")
+            self.reported_drops = dropped
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.next_publish) < 0:
+            return
+        if not self.mqtt.started: # offline use stays offline
+            self.next_publish = time.ticks_add(now, self.interval_ms)
+            return
+        if not self.mqtt.connected():
+            return
+        self.next_publish = time.ticks_add(now, self.interval_ms)
+        self.collect() # also makes mem_free exact
+        self.topic.publish(ujson.dumps(self.snapshot()))
+
 rotary_encoder = RotaryEncoder()
-history = History(rotary_encoder)
-hrv = HrvAnalysis(rotary_encoder, history)
-kubios = Kubios(rotary_encoder, history, hrv)
-menu = MainMenu(rotary_encoder)
-hr = HrMeasurement(rotary_encoder, SAMPLE_RATE)
+hw = Hardware()
+boot_mark("hardware")
+buffers = BufferPool(SAMPLE_RATE)
+history = History(rotary_encoder, hw)
+boot_mark("history")
+mqtt = MqttConnection(BROKER_IP, BROKER_PORT, Outbox(), Wlan(WLAN_SSID, WLAN_PASSWORD))
+if len(mqtt.outbox):
+    mqtt.start() # unsent messages from before the reboot
+boot_mark("outbox")
+hrv = HrvAnalysis(rotary_encoder, hw, history, buffers, mqtt)
+kubios = Kubios(rotary_encoder, hw, history, hrv, buffers, mqtt)
+menu = MainMenu(rotary_encoder, hw)
+hr = HrMeasurement(rotary_encoder, hw, SAMPLE_RATE, buffers)
+boot_mark("screens")
 
-timer_on = False
-# Main loop
+screens = [menu, hr, hrv, kubios, history] # indexed by state
+diagnostics = Diagnostics(mqtt, rotary_encoder)
+diagnostics.watch("hr", hr.samples)
+diagnostics.watch("hrv", hrv.samples)
+if hrv.worker:
+    diagnostics.watch("core1", hrv.worker.intervals)
+    diagnostics.worker = hrv.worker
 
-if __name__ == "__main__":
+# Tasks. Each one does a little work and sleeps, so uasyncio idles the CPU in between and a
+# slow step (a redraw, an MQTT connect) only delays the others instead of freezing them.
+async def encoder_task():
     while True:
-        if state == 0:  # main menu
-            if timer_on:
-                tmr.deinit() # sample timer off
-                timer_on = False
-            menu.execute()
-        elif state == 1: # HR measurement
-            if not timer_on:
-                tmr = Piotimer(mode=Piotimer.PERIODIC, freq=SAMPLE_RATE, callback=hr.read_adc) # sample timer on
-                timer_on = True
-            hr.execute()
-        elif state == 2: # HRV analysis
-            hrv.execute()
-        elif state == 3: # Kubios
-            kubios.execute()
-        elif state == 4: # History
-            history.execute()
-            
+        await rotary_encoder.flag.wait() # set by the encoder interrupts
+        start = time.ticks_us()
+        current = state
+        while rotary_encoder.fifo.has_data():
+            old_state = state
+            screens[state].on_event(rotary_encoder.fifo.get())
+            if state != old_state:
+                screens[old_state].leave()
+                screens[state].enter()
+        diagnostics.loop_time(current, time.ticks_diff(time.ticks_us(), start))
+
+# Every task step is timed for the diagnostics, under the state it started in
+async def sampler_task():
+    while True:
+        start = time.ticks_us()
+        current = state
+        screens[current].process_samples()
+        diagnostics.loop_time(current, time.ticks_diff(time.ticks_us(), start))
+        await asyncio.sleep_ms(20) # 5 samples at 250 Hz, the sample rings hold 63
 
+async def ui_task():
+    while True:
+        start = time.ticks_us()
+        current = state
+        screens[current].update()
+        diagnostics.loop_time(current, time.ticks_diff(time.ticks_us(), start))
+        await asyncio.sleep_ms(50)
+
+async def network_task():
+    while True:
+        start = time.ticks_us()
+        current = state
+        # A blocking MQTT connect would overflow the sample ring of a capture on core 0
+        mqtt.paused = screens[current].core0_sampling()
+        mqtt.poll()
+        hrv.send_pending()
+        kubios.client.poll()
+        diagnostics.poll()
+        diagnostics.loop_time(current, time.ticks_diff(time.ticks_us(), start))
+        await asyncio.sleep_ms(100)
+
+async def main():
+    screens[state].enter()
+    screens[state].update()
+    boot_mark("menu shown")
+    boot_report()
+    asyncio.create_task(encoder_task())
+    asyncio.create_task(sampler_task())
+    asyncio.create_task(network_task())
+    await ui_task()
+
+if __name__ == "__main__":
+    asyncio.run(main())
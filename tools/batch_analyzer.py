@@ -0,0 +1,124 @@
+# Host-side batch analyzer for recorded capture_250Hz_*.txt files.
+# Runs the same peak / interval / frequency pipeline as week2/2.1_positivepeaks.py and the
+# min/max of week2/2.2_printscaledvalues.py, but on whole files at once with NumPy and
+# on many files in parallel. Writes one summary per capture file.
+#
+# Usage:
+#   python tools/batch_analyzer.py captures/ -o results/ --format json --jobs 8
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+SAMPLING_RATE = 250  # Samples per second (250 Hz)
+
+
+# Reads a capture file (one integer sample per line, same files Filefifo reads) into an array
+def read_capture(path):
+    return np.fromfile(path, dtype=np.int64, sep=" ")
+
+
+# Peaks using slope inspection: signal[i - 1] < signal[i] > signal[i + 1], without a Python loop
+def find_peaks(signal):
+    slope = np.diff(signal)
+    return np.flatnonzero((slope[:-1] > 0) & (slope[1:] < 0)) + 1
+
+
+# Peak-to-peak intervals in samples and in seconds
+def calculate_intervals(peaks_indices, sampling_rate):
+    intervals_samples = np.diff(peaks_indices)
+    return intervals_samples, intervals_samples / sampling_rate
+
+
+# Runs the whole pipeline on one file and returns the summary as a dict
+def analyze_file(path, sampling_rate=SAMPLING_RATE):
+    signal = read_capture(path)
+    peaks_indices = find_peaks(signal)
+    intervals_samples, intervals_seconds = calculate_intervals(peaks_indices, sampling_rate)
+
+    # Calculate frequency from the intervals
+    if len(intervals_seconds) > 0:
+        average_interval = float(intervals_seconds.mean())
+        signal_frequency = 1 / average_interval
+    else:
+        average_interval = 0.0
+        signal_frequency = 0.0
+
+    return {
+        "file": os.path.basename(path),
+        "samples": int(len(signal)),
+        "duration_s": len(signal) / sampling_rate,
+        "min": int(signal.min()) if len(signal) else 0,
+        "max": int(signal.max()) if len(signal) else 0,
+        "peaks": int(len(peaks_indices)),
+        "first_peaks": peaks_indices[:3].tolist(),
+        "first_intervals_samples": intervals_samples[:3].tolist(),
+        "mean_interval_s": average_interval,
+        "frequency_hz": signal_frequency,
+    }
+
+
+def write_summary(summary, out_dir, fmt):
+    name = os.path.splitext(summary["file"])[0]
+    out_path = os.path.join(out_dir, f"{name}.{fmt}")
+    if fmt == "json":
+        with open(out_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        row = dict(summary)
+        row["first_peaks"] = " ".join(str(i) for i in row["first_peaks"])
+        row["first_intervals_samples"] = " ".join(str(i) for i in row["first_intervals_samples"])
+        with open(out_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(row))
+            writer.writeheader()
+            writer.writerow(row)
+    return out_path
+
+
+# Worker for the process pool: analyze one file and write its summary next to the others
+def process_file(args):
+    path, out_dir, fmt, sampling_rate = args
+    return write_summary(analyze_file(path, sampling_rate), out_dir, fmt)
+
+
+# Collects capture files from the given files and directories
+def find_captures(paths, pattern_prefix="capture_"):
+    captures = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.startswith(pattern_prefix) and name.endswith(".txt"):
+                    captures.append(os.path.join(path, name))
+        else:
+            captures.append(path)
+    return captures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze capture_250Hz_*.txt files in parallel.")
+    parser.add_argument("paths", nargs="+", help="capture files or directories containing them")
+    parser.add_argument("-o", "--out", default=".", help="directory for the summaries")
+    parser.add_argument("-f", "--format", choices=("json", "csv"), default="json")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("-r", "--rate", type=int, default=SAMPLING_RATE, help="sampling rate in Hz")
+    args = parser.parse_args(argv)
+
+    captures = find_captures(args.paths)
+    if not captures:
+        print("No capture files found", file=sys.stderr)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    jobs = [(path, args.out, args.format, args.rate) for path in captures]
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for out_path in pool.map(process_file, jobs, chunksize=4):
+            print(out_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+# Runs sallimonitor/benchmark.py on the host. The app is loaded through the simulation
+# harness (stand-in hardware), the benchmark itself times with the host's real clock.
+#
+# Usage:
+#   python tools/benchmark.py --capture capture_250Hz_01.txt --label "fixed-point filter"
+import argparse
+import os
+import sys
+
+from simulate import load_app
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "sallimonitor"))
+
+import benchmark  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the HRV DSP chain on the host.")
+    parser.add_argument("--capture", help="capture_250Hz_*.txt file (default: synthetic signal)")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per stage, the fastest counts")
+    parser.add_argument("--label", default="", help="note stored with the results")
+    parser.add_argument("--history", default=benchmark.HISTORY_FILE, help="results history file")
+    args = parser.parse_args(argv)
+
+    app = load_app()
+    benchmark.run(app, args.capture, args.repeat, args.label, args.history)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
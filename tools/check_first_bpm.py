@@ -0,0 +1,64 @@
+# Checks how long the HR screen takes to show its first BPM, on the simulated hardware.
+# Enters the screen at a few pulse rates and start phases and fails if the first reading
+# comes later than --limit beats after entering, or is off by more than --tolerance bpm
+# (a spurious first interval, e.g. from the dicrotic notch). A reading needs two peaks, so it
+# can't come sooner than one beat; the tracker's warm-up adds one or two more.
+#
+# Usage:
+#   python tools/check_first_bpm.py
+#   python tools/check_first_bpm.py --bpm 55 70 120 --seeds 1 2 3 --limit 2.5
+import argparse
+import contextlib
+import io
+import re
+import sys
+
+from simulate import load_app, make_signal
+from simhw import world
+
+BPM_TEXT = re.compile(r"BPM: (\d+)")
+
+
+# Returns (seconds from entering the screen to the first BPM, that BPM), or (None, None)
+def first_bpm(bpm, seed, enter=1.0, duration=8.0):
+    first = {}
+
+    def on_frame(display):
+        if first:
+            return
+        for line in display.screen():
+            match = BPM_TEXT.search(line)
+            if match:
+                first["time"] = world.clock.now_us / 1e6 - enter
+                first["bpm"] = int(match.group(1))
+
+    with contextlib.redirect_stdout(io.StringIO()): # the app's own prints
+        load_app(run_name="__main__", signal=make_signal(bpm=bpm, seed=seed), wifi=False,
+                 script=f"{enter}:press", duration=enter + duration, on_frame=on_frame)
+    return first.get("time"), first.get("bpm")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the time to the first BPM on the HR screen.")
+    parser.add_argument("--bpm", type=float, nargs="+", default=[55, 70, 90, 120], help="pulse rates")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3, 4, 5], help="signal seeds")
+    parser.add_argument("--limit", type=float, default=3, help="latest first BPM, beats after entering")
+    parser.add_argument("--tolerance", type=int, default=8, help="allowed error of the first BPM")
+    args = parser.parse_args(argv)
+
+    failures = 0
+    for bpm in args.bpm:
+        for seed in args.seeds:
+            # Different entry times start the detector at different phases of the beat
+            enter = 1.0 + 0.13 * seed
+            delay, shown = first_bpm(bpm, seed, enter)
+            ok = delay is not None and delay <= args.limit * 60 / bpm and abs(shown - bpm) <= args.tolerance
+            failures += not ok
+            result = f"first BPM after {delay:.2f} s, {shown} bpm" if delay is not None else "no BPM"
+            print(f"{bpm:5.0f} bpm seed {seed}: {result}{'' if ok else '  FAIL'}")
+    print(f"{failures} failed" if failures else "all passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
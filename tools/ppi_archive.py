@@ -0,0 +1,105 @@
+# Host-side reader for the PPI archive main_V3.py keeps on the Pico (ppi.bin + ppi.idx),
+# for analysing old HRV sessions again on a PC. Copy the two files off the device, e.g.
+#   mpremote cp :ppi.bin :ppi.idx .
+#
+# Usage:
+#   python tools/ppi_archive.py .                      # list the sessions
+#   python tools/ppi_archive.py . --session 3          # intervals of one session
+#   python tools/ppi_archive.py . --format json -o sessions.json
+import argparse
+import csv
+import json
+import os
+import struct
+import sys
+import time
+
+INDEX = "<IIHH"  # time (s since epoch), offset in ppi.bin, length in bytes, intervals
+
+
+# Same format as encode_ppi() in main_V3.py: zigzag varint deltas, the first one to 0
+def decode_ppi(data):
+    intervals = []
+    prev = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte & 0x80:
+            continue
+        prev += (value >> 1) if not value & 1 else -((value + 1) >> 1)
+        intervals.append(prev)
+        value = 0
+        shift = 0
+    return intervals
+
+
+def read_archive(directory):
+    with open(os.path.join(directory, "ppi.idx"), "rb") as f:
+        index = f.read()
+    with open(os.path.join(directory, "ppi.bin"), "rb") as f:
+        data = f.read()
+
+    sessions = []
+    row_size = struct.calcsize(INDEX)
+    for number, row in enumerate(struct.iter_unpack(INDEX, index[:len(index) // row_size * row_size])):
+        date, offset, length, count = row
+        intervals = decode_ppi(data[offset:offset + length])
+        if len(intervals) != count:
+            print(f"session {number}: expected {count} intervals, decoded {len(intervals)}", file=sys.stderr)
+        sessions.append({
+            "session": number,
+            "time": date,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(date)),
+            "bytes": length,
+            "ppi": intervals,
+        })
+    return sessions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode the PPI archive (ppi.bin + ppi.idx) of the Pico.")
+    parser.add_argument("directory", help="directory with ppi.bin and ppi.idx")
+    parser.add_argument("-s", "--session", type=int, help="only this session (0 = oldest)")
+    parser.add_argument("-f", "--format", choices=("list", "json", "csv"), default="list")
+    parser.add_argument("-o", "--out", help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    sessions = read_archive(args.directory)
+    if args.session is not None:
+        sessions = [s for s in sessions if s["session"] == args.session]
+        if not sessions:
+            print(f"No session {args.session}", file=sys.stderr)
+            return 1
+
+    out = open(args.out, "w", newline="") if args.out else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump(sessions, out, indent=1)
+            out.write("\n")
+        elif args.format == "csv":
+            writer = csv.writer(out)
+            writer.writerow(["session", "time", "index", "ppi_ms"])
+            for s in sessions:
+                for i, ppi in enumerate(s["ppi"]):
+                    writer.writerow([s["session"], s["time"], i, ppi])
+        else:
+            stored = 0
+            as_json = 0
+            for s in sessions:
+                stored += s["bytes"]
+                as_json += len(json.dumps(s["ppi"]))
+                print(f"{s['session']:4}  {s['date']}  {len(s['ppi']):4} intervals  {s['bytes']:5} bytes"
+                      + ("  " + " ".join(str(p) for p in s["ppi"]) if args.session is not None else ""))
+            if stored:
+                print(f"{len(sessions)} sessions, {stored} bytes stored, {as_json} bytes as JSON lists "
+                      f"({as_json / stored:.1f}x)")
+    finally:
+        if args.out:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
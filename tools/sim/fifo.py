@@ -0,0 +1,44 @@
+# Stand-in for the course fifo.py with the same ring buffer and drop counter.
+# Outside uasyncio, polling an empty fifo lets the virtual clock jump to the next event
+# (timer tick, encoder input), which is how busy loops run faster than real time.
+import array
+
+from simhw import world
+
+
+class Fifo:
+    def __init__(self, size, typecode='H'):
+        self.data = array.array(typecode, [0] * size)
+        self.head = 0
+        self.tail = 0
+        self.size = size
+        self.dc = 0
+
+    def put(self, value):
+        nh = (self.head + 1) % self.size
+        if nh != self.tail:
+            self.data[self.head] = value
+            self.head = nh
+        else:
+            self.dc = self.dc + 1
+
+    def get(self):
+        if self.head != self.tail:
+            val = self.data[self.tail]
+            self.tail = (self.tail + 1) % self.size
+            return val
+        else:
+            raise RuntimeError("Fifo is empty")
+
+    def dropped(self):
+        return self.dc
+
+    def has_data(self):
+        if self.head == self.tail and world.idle_on_poll:
+            world.clock.idle()
+        return self.head != self.tail
+
+    def empty(self):
+        if self.head == self.tail and world.idle_on_poll:
+            world.clock.idle()
+        return self.head == self.tail
@@ -0,0 +1,70 @@
+# Stand-in for MicroPython's machine module: Pin with interrupts, I2C and an ADC that
+# reads the simulated signal at the current virtual time.
+from simhw import world
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+        self.id = pin_id
+        self._value = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self._value = int(bool(value))
+        self._handler = None
+        world.pins[pin_id] = self
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = int(bool(value))
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler = handler
+
+    def _trigger(self):
+        if self._handler:
+            self._handler(self)
+
+
+class I2C:
+    def __init__(self, bus_id, scl=None, sda=None, freq=400000):
+        self.bus_id = bus_id
+        self.freq = freq
+
+    def scan(self):
+        return [0x3C]
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self):
+        return world.signal.value_at(world.clock.now_us)
+
+
+def freq(hz=None):
+    return 125000000
+
+
+def reset():
+    raise SystemExit("machine.reset()")
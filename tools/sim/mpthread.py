@@ -0,0 +1,71 @@
+# Stand-in for MicroPython's _thread (the second core of the RP2040). The harness installs
+# it as `_thread` while it loads the app. A new thread is a real host thread, but it runs in
+# lockstep with the virtual clock: only one of the app's threads runs at a time, and a
+# time.sleep_*() on the thread hands control back to the main thread until the clock reaches
+# the wake-up time. Runs stay deterministic while everything the two cores share still
+# crosses a real thread boundary.
+import threading
+import traceback
+
+from simhw import world
+
+_local = threading.local()
+
+
+class _Thread:
+    def __init__(self, func, args, kwargs):
+        self.turn = threading.Semaphore(0)  # released when the thread may run
+        self.back = threading.Semaphore(0)  # released when the main thread may run again
+        self.thread = threading.Thread(target=self._main, args=(func, args, kwargs), daemon=True)
+        self.thread.start()
+
+    def _main(self, func, args, kwargs):
+        _local.thread = self
+        self.turn.acquire()
+        try:
+            func(*args, **kwargs)
+        except SystemExit:
+            pass
+        except BaseException as e:
+            print(f"Unhandled exception in thread started by {func}")
+            traceback.print_exception(e)
+        finally:
+            self.back.release()
+
+    # Main thread: lets the thread run until it sleeps or returns
+    def resume(self):
+        self.turn.release()
+        self.back.acquire()
+
+    # The thread itself: parks until the virtual clock is `us` further
+    def sleep_us(self, us):
+        world.clock.schedule(us, self.resume)
+        self.back.release()
+        self.turn.acquire()
+
+
+# Used by utime: True when the calling thread is one started here and has slept
+def sleep_us(us):
+    thread = getattr(_local, "thread", None)
+    if thread is None:
+        return False
+    thread.sleep_us(us)
+    return True
+
+
+def start_new_thread(func, args, kwargs=None):
+    thread = _Thread(func, args, kwargs or {})
+    thread.resume()  # runs right away, like core 1 does
+    return thread.thread.ident
+
+
+def allocate_lock():
+    return threading.Lock()
+
+
+def get_ident():
+    return threading.get_ident()
+
+
+def exit():
+    raise SystemExit
@@ -0,0 +1,42 @@
+# Stand-in for the network module. The WLAN connects after world.wifi_delay_us of virtual
+# time, or never when the world was reset with wifi=False.
+from simhw import world
+
+STA_IF = 0
+AP_IF = 1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+        self._event = None
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+
+    def connect(self, ssid=None, password=None):
+        if self._event or self._connected:
+            return
+        if world.wifi:
+            self._event = world.clock.schedule(world.wifi_delay_us, self._up)
+
+    def _up(self):
+        self._connected = True
+        self._event = None
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected
+
+    def status(self):
+        return STAT_GOT_IP if self._connected else 1
+
+    def ifconfig(self):
+        return ("192.168.50.100", "255.255.255.0", "192.168.50.1", "8.8.8.8")
@@ -0,0 +1,15 @@
+# Stand-in for the course Piotimer: a periodic callback driven by the virtual clock.
+from simhw import world, PeriodicTimer
+
+
+class Piotimer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=0, mode=PERIODIC, freq=1, period=None, callback=None):
+        if period is not None:
+            freq = 1000 / period
+        self._timer = PeriodicTimer(world.clock, freq, callback, periodic=(mode == Piotimer.PERIODIC))
+
+    def deinit(self):
+        self._timer.cancel()
@@ -0,0 +1,268 @@
+# Core of the host simulation: a virtual clock, signal sources for the ADC, the rotary
+# encoder script and a loopback MQTT broker with a fake Kubios service.
+# The stand-in modules next to this file (machine, piotimer, ssd1306, fifo, network,
+# umqtt.simple, utime, ...) all talk to the one `world` object defined at the bottom.
+import heapq
+import json
+import math
+import random
+
+
+# Raised from inside the app when the simulated run is over. It is a BaseException so the
+# app's own `except Exception` blocks don't swallow it.
+class SimulationEnd(BaseException):
+    pass
+
+
+class Clock:
+    # Virtual microsecond clock with a queue of timed callbacks. Nothing sleeps for real:
+    # when the app waits for something the clock jumps straight to the next event.
+    def __init__(self):
+        self.now_us = 0
+        self.end_us = None
+        self.events = []  # heap of (time_us, seq, callback)
+        self.seq = 0
+
+    def schedule(self, delay_us, callback):
+        self.seq += 1
+        event = [self.now_us + max(0, int(delay_us)), self.seq, callback]
+        heapq.heappush(self.events, event)
+        return event
+
+    def cancel(self, event):
+        event[2] = None  # lazy removal, skipped when popped
+
+    def _run_until(self, t_us):
+        while self.events and self.events[0][0] <= t_us:
+            when, _, callback = heapq.heappop(self.events)
+            if callback is None:
+                continue
+            self.now_us = max(self.now_us, when)
+            self._check_end()
+            callback()
+        self.now_us = max(self.now_us, t_us)
+        self._check_end()
+
+    def _check_end(self):
+        if self.end_us is not None and self.now_us >= self.end_us:
+            raise SimulationEnd("simulated time is up")
+
+    def advance(self, us):
+        self._run_until(self.now_us + int(us))
+
+    # Called when the app polls for something that isn't there yet (an empty fifo, a missing
+    # MQTT message). Jumps to the next event so busy-wait loops run faster than real time.
+    def idle(self):
+        while self.events and self.events[0][2] is None:
+            heapq.heappop(self.events)
+        if not self.events:
+            raise SimulationEnd("app is idle and nothing is scheduled")
+        self._run_until(self.events[0][0])
+
+
+class PeriodicTimer:
+    def __init__(self, clock, freq, callback, periodic=True):
+        self.clock = clock
+        self.period_us = 1000000 / freq
+        self.callback = callback
+        self.periodic = periodic
+        self.count = 0
+        self.start_us = clock.now_us
+        self.event = None
+        self._arm()
+
+    def _arm(self):
+        # Scheduled from the start time so rounding doesn't drift over long runs
+        due = self.start_us + round((self.count + 1) * self.period_us)
+        self.event = self.clock.schedule(due - self.clock.now_us, self._fire)
+
+    def _fire(self):
+        self.count += 1
+        if self.periodic:
+            self._arm()
+        else:
+            self.event = None
+        self.callback(self)
+
+    def cancel(self):
+        if self.event:
+            self.clock.cancel(self.event)
+            self.event = None
+
+
+# Signal sources for the ADC. value_at(t_us) returns a 16-bit reading at virtual time t.
+class CaptureSignal:
+    # Replays a capture_250Hz_*.txt file (one sample per line), looping at the end.
+    def __init__(self, path, sample_rate=250):
+        with open(path) as f:
+            self.samples = [int(line) for line in f if line.strip()]
+        self.period_us = 1000000 // sample_rate
+
+    def value_at(self, t_us):
+        return self.samples[(t_us // self.period_us) % len(self.samples)]
+
+
+class SyntheticPulse:
+    # PPG-like pulse train with beat-to-beat variation, baseline wander and noise.
+    def __init__(self, bpm=70, variability=0.05, seed=1):
+        self.rng = random.Random(seed)
+        self.mean_ibi_us = 60000000 / bpm
+        self.variability = variability
+        self.beat_start = 0
+        self.ibi = self._next_ibi()
+
+    def _next_ibi(self):
+        return self.mean_ibi_us * (1 + self.rng.uniform(-self.variability, self.variability))
+
+    def value_at(self, t_us):
+        while t_us >= self.beat_start + self.ibi:
+            self.beat_start += self.ibi
+            self.ibi = self._next_ibi()
+        phase = (t_us - self.beat_start) / self.ibi
+        t = t_us / 1000000
+        value = 30000 + 1500 * math.sin(2 * math.pi * t / 20)
+        value += 9000 * math.exp(-((phase - 0.2) / 0.06) ** 2)
+        value += 2500 * math.exp(-((phase - 0.45) / 0.08) ** 2)
+        value += self.rng.gauss(0, 120)
+        return max(0, min(65535, int(value)))
+
+
+class Broker:
+    # In-process MQTT broker. Messages are delivered into the subscribed clients' inboxes
+    # after `latency_us` of virtual time.
+    def __init__(self, clock):
+        self.clock = clock
+        self.up = True
+        self.reachable = True    # False = no answer at all, connects hang until they time out
+        self.connect_stall_us = 20000000  # how long the stack waits for the SYN-ACK without a timeout
+        self.latency_us = 2000
+        self.subscriptions = {}  # topic -> list of subscribers
+        self.published = []      # (time_us, topic, msg) log of everything published
+        self.connects = 0        # CONNECTs accepted
+        self.clients = set()     # clients with an open connection
+        self.pings = 0
+
+    def subscribe(self, topic, subscriber):
+        subscribers = self.subscriptions.setdefault(topic, [])
+        if subscriber not in subscribers:
+            subscribers.append(subscriber)
+
+    def unsubscribe_all(self, subscriber):
+        for subscribers in self.subscriptions.values():
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+
+    def publish(self, topic, msg):
+        self.published.append((self.clock.now_us, topic, msg))
+        for subscriber in list(self.subscriptions.get(topic, ())):
+            self.clock.schedule(self.latency_us, lambda s=subscriber: s.deliver(topic, msg))
+
+
+class KubiosService:
+    # Stands in for the Kubios cloud proxy: answers every kubios-request with an analysis
+    # computed from the RRI list, after `delay_us`.
+    request_topic = b"kubios-request"
+    response_topic = b"kubios-response"
+
+    def __init__(self, broker, delay_us=1500000):
+        self.broker = broker
+        self.delay_us = delay_us
+        self.enabled = True
+        broker.subscribe(self.request_topic, self)
+
+    def deliver(self, topic, msg):
+        if not self.enabled:
+            return
+        request = json.loads(msg)
+        reply = json.dumps(self.analyse(request)).encode()
+        self.broker.clock.schedule(self.delay_us, lambda: self.broker.publish(self.response_topic, reply))
+
+    def analyse(self, request):
+        rri = request.get("data") or [1000]
+        n = len(rri)
+        mean_rr = sum(rri) / n
+        sdnn = math.sqrt(sum((x - mean_rr) ** 2 for x in rri) / max(1, n - 1))
+        rmssd = math.sqrt(sum((b - a) ** 2 for a, b in zip(rri, rri[1:])) / max(1, n - 1))
+        return {
+            "id": request.get("id"),
+            "type": "readiness",
+            "data": {
+                "status": "ok",
+                "analysis": {
+                    "mean_hr_bpm": 60000 / mean_rr,
+                    "mean_rr_ms": mean_rr,
+                    "rmssd_ms": rmssd,
+                    "sdnn_ms": sdnn,
+                    "sns_index": (900 - mean_rr) / 100,
+                    "pns_index": (rmssd - 30) / 10,
+                },
+            },
+        }
+
+
+class World:
+    # Everything the stand-in modules share. Reset between runs with world.reset().
+    def __init__(self):
+        self.reset()
+
+    def reset(self, signal=None, wifi=True, wifi_delay_us=2000000):
+        self.clock = Clock()
+        self.signal = signal or SyntheticPulse()
+        self.pins = {}             # pin id -> stand-in Pin
+        self.wifi = wifi           # False = the access point never answers
+        self.wifi_delay_us = wifi_delay_us
+        self.broker = Broker(self.clock)
+        self.kubios = KubiosService(self.broker)
+        self.displays = []         # every SSD1306_I2C created
+        self.panels = {}           # I2C address -> emulated panel
+        self.last_display = None   # driver object that last wrote to a panel
+        self.i2c_bytes = 0         # bytes sent to the display
+        self.frames = 0            # full-frame show() calls of the driver
+        self.on_frame = None       # callback(display) after every display data write
+        self.idle_on_poll = True   # polling an empty fifo jumps the clock (off under uasyncio)
+
+    def pin(self, pin_id):
+        return self.pins.get(pin_id)
+
+    # Rotary encoder input as the real hardware would produce it. The app reads the B pin
+    # inside the A pin interrupt to tell the direction.
+    def rotate(self, steps, a_pin=10, b_pin=11):
+        a = self.pin(a_pin)
+        b = self.pin(b_pin)
+        for _ in range(abs(steps)):
+            if b is not None:
+                b._value = 0 if steps > 0 else 1
+            if a is not None:
+                a._trigger()
+
+    def press(self, btn_pin=12):
+        sw = self.pin(btn_pin)
+        if sw is not None:
+            sw._trigger()
+
+    # Schedules a script of user actions, e.g. "1:press 2.5:right 3:left 40:press".
+    # Times are seconds of virtual time from now.
+    def script(self, text):
+        for item in text.split():
+            when, action = item.split(":", 1)
+            delay_us = float(when) * 1000000
+            if action == "press":
+                self.clock.schedule(delay_us, self.press)
+            elif action in ("right", "left"):
+                steps = 1 if action == "right" else -1
+                self.clock.schedule(delay_us, lambda s=steps: self.rotate(s))
+            elif action == "broker-down":
+                self.clock.schedule(delay_us, lambda: setattr(self.broker, "up", False))
+            elif action == "broker-up":
+                self.clock.schedule(delay_us, lambda: setattr(self.broker, "up", True))
+            elif action in ("broker-unreachable", "broker-reachable"):
+                reachable = action == "broker-reachable"
+                self.clock.schedule(delay_us, lambda r=reachable: setattr(self.broker, "reachable", r))
+            elif action in ("kubios-down", "kubios-up"):
+                up = action == "kubios-up"
+                self.clock.schedule(delay_us, lambda u=up: setattr(self.kubios, "enabled", u))
+            else:
+                raise ValueError(f"unknown action {action!r}")
+
+
+world = World()
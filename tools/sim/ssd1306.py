@@ -0,0 +1,168 @@
+# Stand-in for the SSD1306 driver. Keeps an in-memory MONO_VLSB framebuffer like
+# framebuf.FrameBuffer, emulates the controller's display RAM and address window so partial
+# updates land where they would on the real panel, and charges I2C time on the virtual clock.
+# Every driver object on the same I2C address draws on the same emulated panel.
+from simhw import world
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+
+def _glyph(ch):
+    # No font on the host; every printable character gets a distinct 8-column pattern so
+    # text changes still change the framebuffer.
+    if ch == " ":
+        return bytes(8)
+    code = ord(ch)
+    return bytes(0x80 | ((code * 37 + col * 11) & 0x7F) for col in range(7)) + b"\x00"
+
+
+class Panel:
+    # The controller side: display RAM plus the column/page address window
+    def __init__(self, width, pages):
+        self.width = width
+        self.gddram = bytearray(pages * width)
+        self.cmd_args = []
+        self.window = [0, width - 1, 0, pages - 1]
+        self.cursor = [0, 0]
+
+
+class SSD1306_I2C:
+    def __init__(self, width, height, i2c, addr=0x3C, external_vcc=False):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.i2c = i2c
+        self.addr = addr
+        self.buffer = bytearray(self.pages * width)
+        self.panel = world.panels.setdefault(addr, Panel(width, self.pages))
+        self.texts = []  # (x, y, string) drawn since the last fill, for screen dumps
+        world.displays.append(self)
+        self._i2c_time(25)  # init command sequence
+
+    # --- framebuf.FrameBuffer subset ---
+    def fill(self, c):
+        value = 0xFF if c else 0
+        for i in range(len(self.buffer)):
+            self.buffer[i] = value
+        self.texts = []
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return 0 if c is None else None
+        index = (y >> 3) * self.width + x
+        bit = 1 << (y & 7)
+        if c is None:
+            return 1 if self.buffer[index] & bit else 0
+        if c:
+            self.buffer[index] |= bit
+        else:
+            self.buffer[index] &= ~bit & 0xFF
+
+    def hline(self, x, y, w, c):
+        for i in range(w):
+            self.pixel(x + i, y, c)
+
+    def vline(self, x, y, h, c):
+        for i in range(h):
+            self.pixel(x, y + i, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        steps = max(abs(x2 - x1), abs(y2 - y1), 1)
+        for i in range(steps + 1):
+            self.pixel(x1 + (x2 - x1) * i // steps, y1 + (y2 - y1) * i // steps, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            return self.fill_rect(x, y, w, h, c)
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def fill_rect(self, x, y, w, h, c):
+        for j in range(h):
+            self.hline(x, y + j, w, c)
+
+    def text(self, s, x, y, c=1):
+        self.texts.append((x, y, str(s)))
+        for n, ch in enumerate(str(s)):
+            for col, bits in enumerate(_glyph(ch)):
+                for row in range(8):
+                    if bits & (1 << row):
+                        self.pixel(x + n * 8 + col, y + row, c)
+
+    def scroll(self, xstep, ystep):
+        pass
+
+    # --- SSD1306 driver API ---
+    def poweroff(self):
+        self.write_cmd(0xAE)
+
+    def poweron(self):
+        self.write_cmd(0xAF)
+
+    def contrast(self, contrast):
+        self.write_cmd(0x81)
+        self.write_cmd(contrast)
+
+    def invert(self, invert):
+        self.write_cmd(0xA6 | (invert & 1))
+
+    def show(self):
+        self.write_cmd(SET_COL_ADDR)
+        self.write_cmd(0)
+        self.write_cmd(self.width - 1)
+        self.write_cmd(SET_PAGE_ADDR)
+        self.write_cmd(0)
+        self.write_cmd(self.pages - 1)
+        self.write_data(self.buffer)
+        world.frames += 1
+
+    def write_cmd(self, cmd):
+        self._i2c_time(2)
+        panel = self.panel
+        if panel.cmd_args:
+            panel.cmd_args.append(cmd)
+            if len(panel.cmd_args) == 3:
+                op, start, end = panel.cmd_args
+                if op == SET_COL_ADDR:
+                    panel.window[0:2] = [start, end]
+                else:
+                    panel.window[2:4] = [start, end]
+                panel.cursor = [panel.window[0], panel.window[2]]
+                panel.cmd_args = []
+        elif cmd in (SET_COL_ADDR, SET_PAGE_ADDR):
+            panel.cmd_args = [cmd]
+
+    def write_data(self, buf):
+        self._i2c_time(len(buf) + 1)
+        panel = self.panel
+        x0, x1, p0, p1 = panel.window
+        col, page = panel.cursor
+        for byte in bytes(buf):
+            panel.gddram[page * self.width + col] = byte
+            col += 1
+            if col > x1:
+                col = x0
+                page = p0 if page >= p1 else page + 1
+        panel.cursor = [col, page]
+        world.last_display = self
+        if world.on_frame:
+            world.on_frame(self)
+
+    def _i2c_time(self, nbytes):
+        # address byte + payload, 9 clocks per byte
+        nbytes += 1
+        world.i2c_bytes += nbytes
+        freq = getattr(self.i2c, "freq", 400000) or 400000
+        world.clock.advance(nbytes * 9 * 1000000 // freq)
+
+    # --- host helpers ---
+    def in_sync(self):
+        # True when the panel shows exactly this framebuffer
+        return self.panel.gddram == self.buffer
+
+    def screen(self):
+        # Text currently on screen, top to bottom
+        return [s for _, _, s in sorted(self.texts, key=lambda t: (t[1], t[0]))]
@@ -0,0 +1,213 @@
+# Stand-in for MicroPython's uasyncio on the virtual clock. Same scheduling model: tasks are
+# coroutines that run until they await, sleeping tasks wake from clock events, and when no
+# task is ready the clock jumps to the next event (timer tick, encoder input, MQTT delivery).
+from collections import deque
+
+from simhw import world, SimulationEnd
+
+
+class CancelledError(BaseException):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+_ready = deque()  # (task, exception to throw or None)
+_current = None
+
+
+class _Wait:
+    # Yielded by a task to park itself; `register(task)` arranges for it to be woken
+    def __init__(self, register):
+        self.register = register
+
+    def __await__(self):
+        yield self
+
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exc = None
+        self.waiters = []    # tasks awaiting this one
+        self.unpark = None   # undoes the registration of a parked task
+        _ready.append((self, None))
+
+    def _wake(self, exc=None):
+        self.unpark = None
+        _ready.append((self, exc))
+
+    def _step(self, exc):
+        global _current
+        _current = self
+        try:
+            request = self.coro.throw(exc) if exc else self.coro.send(None)
+        except StopIteration as e:
+            self._finish(e.value, None)
+        except CancelledError as e:
+            self._finish(None, e)
+        except (SimulationEnd, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            self._finish(None, e)
+            if not self.waiters:
+                import traceback
+                print("Task exception wasn't retrieved")
+                traceback.print_exception(e)
+        else:
+            if isinstance(request, _Wait):
+                self.unpark = request.register(self)
+            else:
+                _ready.append((self, None))  # plain yield, run again later
+        finally:
+            _current = None
+
+    def _finish(self, result, exc):
+        self.done = True
+        self.result = result
+        self.exc = exc
+        for task in self.waiters:
+            task._wake()
+        self.waiters = []
+
+    def cancel(self):
+        if self.done:
+            return False
+        if self.unpark:
+            self.unpark()
+        self.unpark = None
+        for i, (task, _) in enumerate(_ready):
+            if task is self:
+                del _ready[i]
+                break
+        _ready.append((self, CancelledError()))
+        return True
+
+    def __await__(self):
+        if not self.done:
+            def register(task):
+                self.waiters.append(task)
+                return lambda: self.waiters.remove(task)
+            yield from _Wait(register).__await__()
+        if self.exc:
+            raise self.exc
+        return self.result
+
+
+def create_task(coro):
+    return Task(coro)
+
+
+def current_task():
+    return _current
+
+
+def sleep_ms(ms):
+    def register(task):
+        event = world.clock.schedule(max(0, ms) * 1000, task._wake)
+        return lambda: world.clock.cancel(event)
+    return _Wait(register)
+
+
+def sleep(seconds):
+    return sleep_ms(seconds * 1000)
+
+
+class Event:
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def is_set(self):
+        return self.state
+
+    def set(self):
+        self.state = True
+        for task in self.waiting:
+            task._wake()
+        self.waiting = []
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        if not self.state:
+            def register(task):
+                self.waiting.append(task)
+                return lambda: self.waiting.remove(task)
+            await _Wait(register)
+        return True
+
+
+# Can be set from an interrupt handler. wait() clears the flag again.
+class ThreadSafeFlag:
+    def __init__(self):
+        self.state = False
+        self.waiting = None
+
+    def set(self):
+        if self.waiting:
+            task, self.waiting = self.waiting, None
+            task._wake()
+        else:
+            self.state = True
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        if self.state:
+            self.state = False
+            return
+        def register(task):
+            self.waiting = task
+            return lambda: setattr(self, "waiting", None)
+        await _Wait(register)
+
+
+async def wait_for_ms(aw, timeout):
+    task = aw if isinstance(aw, Task) else create_task(aw)
+    expired = []
+
+    def expire():
+        if task.cancel():
+            expired.append(True)
+    event = world.clock.schedule(timeout * 1000, expire)
+    try:
+        return await task
+    except CancelledError:
+        if expired:
+            raise TimeoutError()
+        raise
+    finally:
+        world.clock.cancel(event)
+
+
+def wait_for(aw, timeout):
+    return wait_for_ms(aw, timeout * 1000)
+
+
+async def gather(*aws):
+    tasks = [aw if isinstance(aw, Task) else create_task(aw) for aw in aws]
+    return [await task for task in tasks]
+
+
+def run(coro):
+    # Tasks wait on the scheduler, so polling an empty fifo must not advance the clock
+    world.idle_on_poll = False
+    _ready.clear()
+    main = create_task(coro)
+    while not main.done:
+        if _ready:
+            task, exc = _ready.popleft()
+            if not task.done:
+                task._step(exc)
+        else:
+            world.clock.idle()
+    if main.exc:
+        raise main.exc
+    return main.result
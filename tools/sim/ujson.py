@@ -0,0 +1,2 @@
+# Stand-in for ujson.
+from json import dump, dumps, load, loads  # noqa: F401
@@ -0,0 +1,87 @@
+# Stand-in for umqtt.simple talking to the in-process broker in simhw.
+from collections import deque
+
+from simhw import world
+
+
+class MQTTException(Exception):
+    pass
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
+                 ssl=False, ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.cb = None
+        self.connected = False
+        self.inbox = deque()
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        pass
+
+    # Like umqtt.simple 1.4+, timeout (seconds) is set on the socket before it connects
+    def connect(self, clean_session=True, timeout=None):
+        if not world.broker.reachable:
+            # Nobody answers: the call blocks the whole core until the timeout or the stack
+            # gives up, timers keep firing meanwhile
+            world.clock.advance(world.broker.connect_stall_us if timeout is None else timeout * 1000000)
+            raise OSError(110, "ETIMEDOUT")
+        if not world.broker.up:
+            raise OSError(113, "ECONNABORTED")
+        self.connected = True
+        world.broker.connects += 1
+        world.broker.clients.add(self)
+        return False
+
+    def disconnect(self):
+        self.connected = False
+        world.broker.unsubscribe_all(self)
+        world.broker.clients.discard(self)
+
+    def _check(self):
+        if not self.connected or not world.broker.up or not world.broker.reachable:
+            self.connected = False
+            world.broker.clients.discard(self)
+            raise OSError(104, "ECONNRESET")
+
+    def ping(self):
+        self._check()
+        world.broker.pings += 1
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check()
+        world.broker.publish(_bytes(topic), _bytes(msg))
+
+    def subscribe(self, topic, qos=0):
+        self._check()
+        world.broker.subscribe(_bytes(topic), self)
+
+    def deliver(self, topic, msg):
+        if self.connected:
+            self.inbox.append((topic, msg))
+
+    def wait_msg(self):
+        self._check()
+        while not self.inbox:
+            world.clock.idle()
+            self._check()
+        topic, msg = self.inbox.popleft()
+        if self.cb:
+            self.cb(topic, msg)
+        return None
+
+    def check_msg(self):
+        self._check()
+        if self.inbox:
+            return self.wait_msg()
+        return None
+
+
+def _bytes(value):
+    return value.encode() if isinstance(value, str) else bytes(value)
@@ -0,0 +1,75 @@
+# Stand-in for MicroPython's time/utime on the virtual clock. The harness installs this
+# module as `time` while it loads the app, so the app's `import time` gets it.
+import time as _host_time
+
+import mpthread
+from simhw import world
+
+_EPOCH = 1767225600  # 2026-01-01 00:00:00, wall clock at virtual time 0
+_TICKS_PERIOD = 1 << 30
+
+
+def ticks_us():
+    return world.clock.now_us % _TICKS_PERIOD
+
+
+def ticks_ms():
+    return (world.clock.now_us // 1000) % _TICKS_PERIOD
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % _TICKS_PERIOD
+
+
+def ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) % _TICKS_PERIOD
+    if diff >= _TICKS_PERIOD // 2:
+        diff -= _TICKS_PERIOD
+    return diff
+
+
+# The main thread moves the clock itself, a thread from mpthread waits for it
+def sleep_us(us):
+    if not mpthread.sleep_us(us):
+        world.clock.advance(us)
+
+
+def sleep(seconds):
+    sleep_us(seconds * 1000000)
+
+
+def sleep_ms(ms):
+    sleep_us(ms * 1000)
+
+
+def time():
+    return _EPOCH + world.clock.now_us // 1000000
+
+
+def time_ns():
+    return (_EPOCH * 1000000 + world.clock.now_us) * 1000
+
+
+def localtime(secs=None):
+    if secs is None:
+        secs = time()
+    t = _host_time.gmtime(secs)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+
+gmtime = localtime
+
+
+def mktime(t):
+    import calendar
+    return calendar.timegm(tuple(t[:6]) + (0, 0, 0))
+
+
+# Anything else (perf_counter, monotonic, ...) comes from the host, for stdlib code that
+# happens to import time while the app is loaded.
+def __getattr__(name):
+    return getattr(_host_time, name)
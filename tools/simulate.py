@@ -0,0 +1,140 @@
+# Runs sallimonitor/main_V3.py unmodified on the host, with the stand-in hardware modules
+# from tools/sim and a virtual clock, so it runs much faster than real time.
+#
+# Usage:
+#   python tools/simulate.py --duration 90 --script "1:right 1.5:press 80:press"
+#   python tools/simulate.py --capture capture_250Hz_01.txt --script "1:press" --oled
+#
+# Script actions: press, right, left, broker-down, broker-up, broker-unreachable,
+# broker-reachable, kubios-down, kubios-up (times in seconds).
+# Other tools load the app as a module through load_app().
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIM_DIR = os.path.join(HERE, "sim")
+APP = os.path.join(HERE, os.pardir, "sallimonitor", "main_V3.py")
+
+if SIM_DIR not in sys.path:
+    sys.path.insert(0, SIM_DIR)
+
+import mpgc  # noqa: E402
+import mpthread  # noqa: E402
+import utime  # noqa: E402
+from simhw import world, SimulationEnd, CaptureSignal, SyntheticPulse  # noqa: E402
+
+# MicroPython modules whose names clash with CPython builtins. They are swapped in
+# sys.modules only while the app's code runs.
+APP_MODULES = {"time": utime, "_thread": mpthread, "gc": mpgc}
+
+
+class _AppModules:
+    def __enter__(self):
+        self.saved = {name: sys.modules.get(name) for name in APP_MODULES}
+        sys.modules.update(APP_MODULES)
+
+    def __exit__(self, *exc):
+        for name, module in self.saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        return False
+
+
+def make_signal(capture=None, bpm=70, seed=1):
+    if capture:
+        return CaptureSignal(capture)
+    return SyntheticPulse(bpm=bpm, seed=seed)
+
+
+# Loads the app into a fresh module. With run_name="__main__" the main loop runs too, until
+# the duration is used up or the app goes idle; the module is returned either way so its
+# state can be inspected. workdir is where the app reads and writes its files.
+def load_app(path=APP, run_name="main_V3", signal=None, wifi=True, broker_up=True, script=None,
+             duration=None, workdir=None, on_frame=None, broker_reachable=True):
+    world.reset(signal=signal, wifi=wifi)
+    world.broker.up = broker_up
+    world.broker.reachable = broker_reachable
+    world.on_frame = on_frame
+    if duration is not None:
+        world.clock.end_us = int(duration * 1000000)
+    if script:
+        world.script(script)
+
+    module = types.ModuleType(run_name)
+    module.__file__ = os.path.abspath(path)
+    if run_name != "__main__":
+        sys.modules[run_name] = module
+    with open(path) as f:
+        code = compile(f.read(), module.__file__, "exec")
+
+    cwd = os.getcwd()
+    os.chdir(workdir or tempfile.mkdtemp(prefix="sallimonitor-"))
+    try:
+        with _AppModules():
+            exec(code, module.__dict__)
+    except SimulationEnd as e:
+        module.__simulation_end__ = str(e)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+# Runs a function of the loaded app with the MicroPython modules swapped in
+def call(func, *args, **kwargs):
+    with _AppModules():
+        return func(*args, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run main_V3.py on the host on a virtual clock.")
+    parser.add_argument("--app", default=APP, help="app file to run (default: main_V3.py)")
+    parser.add_argument("--duration", type=float, default=60, help="virtual seconds to run")
+    parser.add_argument("--script", default="", help='user input, e.g. "1:right 1.5:press"')
+    parser.add_argument("--capture", help="capture_250Hz_*.txt file to feed the ADC")
+    parser.add_argument("--bpm", type=float, default=70, help="synthetic pulse rate without --capture")
+    parser.add_argument("--offline", action="store_true", help="WLAN never connects")
+    parser.add_argument("--broker-down", action="store_true", help="MQTT broker refuses connections")
+    parser.add_argument("--broker-unreachable", action="store_true", help="MQTT connects hang until they time out")
+    parser.add_argument("--workdir", help="directory for history.bin, outbox.json etc. (default: temp dir)")
+    parser.add_argument("--oled", action="store_true", help="print the OLED text whenever it changes")
+    args = parser.parse_args(argv)
+
+    last = {}
+
+    def print_frame(display):
+        lines = display.screen()
+        if lines != last.get("lines"):
+            last["lines"] = lines
+            print(f"[{world.clock.now_us / 1e6:8.3f}s OLED] " + " | ".join(lines))
+
+    wall_start = time.perf_counter()
+    module = load_app(args.app, "__main__", signal=make_signal(args.capture, args.bpm),
+                      wifi=not args.offline, broker_up=not args.broker_down, script=args.script,
+                      broker_reachable=not args.broker_unreachable,
+                      duration=args.duration, workdir=args.workdir,
+                      on_frame=print_frame if args.oled else None)
+    wall = time.perf_counter() - wall_start
+    virtual = world.clock.now_us / 1e6
+
+    print()
+    print(f"simulation ended: {getattr(module, '__simulation_end__', 'app returned')}")
+    print(f"virtual time {virtual:.1f} s, wall time {wall:.2f} s, {virtual / max(wall, 1e-9):.0f}x real time")
+    print(f"display: {world.frames} full frames, {world.i2c_bytes} bytes over I2C")
+    if world.last_display:
+        print(f"panel matches the last framebuffer drawn: {world.last_display.in_sync()}")
+    broker = world.broker
+    print(f"mqtt: {len(broker.published)} messages published, {broker.connects} connects, "
+          f"{len(broker.clients)} connections open, {broker.pings} pings")
+    for when, topic, msg in broker.published:
+        print(f"  {when / 1e6:8.3f}s {topic.decode()}: {msg[:120].decode()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())